@@ -1,9 +1,10 @@
+import blobstore
 import downloader
 import common
+import converter
 import random
 import traceback
 from datetime import datetime
-import requests
 from bs4 import BeautifulSoup
 
 
@@ -67,13 +68,13 @@ def iterate_source_tags(source_tags, file_name, from_article_url):
                 if raw_source.startswith('/data') else raw_source
 
             # Retrieve the extension and download the file
-            downloader.download_source(file_name, i, source_url)
+            downloader.submit_source(file_name, i, source_url)
         else:
             log('Error: Tag present, but no source found.\n(Tag: %s)\n(%s: Article)' % (tag, from_article_url))
 
 
 def scan_article(url: str):
-    soup = BeautifulSoup(requests.get(url).text, common.Constants.HTML_PARSER)
+    soup = BeautifulSoup(common.get_session().get(url).text, common.Constants.HTML_PARSER)
     article_title = soup.select_one('div.view-wrap h1')['content']
     local_name = __get_local_name(article_title, url)
     domain_tag = '12'
@@ -109,6 +110,7 @@ def scan_article(url: str):
             iterate_source_tags(external_link_tags, '%s-%s-%s' % (domain_tag, local_name, 'a'), url)
         except Exception as video_source_exception:
             log('Error: %s\n%s\n[Traceback]\n%s' % (video_source_exception, url, traceback.format_exc()))
+    downloader.wait_for_downloads()
 
 
 def get_entries_to_scan(placeholder: str, scanning_span: int, page: int = 1) -> ():
@@ -118,7 +120,7 @@ def get_entries_to_scan(placeholder: str, scanning_span: int, page: int = 1) ->
     while page <= max_page:  # Page-wise
         start_time = datetime.now()  # A timer for monitoring performance
         url = placeholder + str(page)
-        soup = BeautifulSoup(requests.get(url).text, common.Constants.HTML_PARSER)
+        soup = BeautifulSoup(common.get_session().get(url).text, common.Constants.HTML_PARSER)
         rows = soup.select('div.list-board > ul.list-body > li.list-item')
 
         for i, row in enumerate(rows):  # Inspect the rows
@@ -180,3 +182,5 @@ def process_domain(domains: tuple, scanning_span: int, starting_page: int = 1):
 
 if __name__ == "__main__":
     process_domain(Constants.ROOT_DOMAIN, scanning_span=Constants.SCANNING_SPAN, starting_page=Constants.STARTING_PAGE)
+    converter.wait_for_conversions()
+    blobstore.collect_garbage_if_due()
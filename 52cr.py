@@ -1,9 +1,10 @@
+import blobstore
 import downloader
 import common
+import converter
 import random
 import traceback
 from datetime import datetime
-import requests
 from bs4 import BeautifulSoup
 
 
@@ -33,7 +34,7 @@ def __get_local_name(doc_title, url):
 
 
 def scan_article(url: str):
-    soup = BeautifulSoup(requests.get(url).text, common.Constants.HTML_PARSER)
+    soup = BeautifulSoup(common.get_session().get(url).text, common.Constants.HTML_PARSER)
     article_title = soup.select_one('h1.ah-title > a').string
     local_name = __get_local_name(article_title, url)
     domain_tag = '52'
@@ -69,6 +70,7 @@ def scan_article(url: str):
             downloader.iterate_source_tags(external_link_tags, '%s-%s-%s' % (domain_tag, local_name, 'a'), url)
         except Exception as video_source_exception:
             log('Error: %s\n%s\n[Traceback]\n%s' % (video_source_exception, url, traceback.format_exc()))
+    downloader.wait_for_downloads()
 
 
 def get_entries_to_scan(placeholder: str, scanning_span: int, page: int = 1) -> ():
@@ -78,7 +80,7 @@ def get_entries_to_scan(placeholder: str, scanning_span: int, page: int = 1) ->
     while page <= max_page:  # Page-wise
         start_time = datetime.now()  # A timer for monitoring performance
         url = placeholder + str(page)
-        soup = BeautifulSoup(requests.get(url).text, common.Constants.HTML_PARSER)
+        soup = BeautifulSoup(common.get_session().get(url).text, common.Constants.HTML_PARSER)
         rows = soup.select('div.ab-webzine > div.wz-item')
 
         for i, row in enumerate(rows):  # Inspect the rows
@@ -140,3 +142,5 @@ def process_domain(domains: tuple, scanning_span: int, starting_page: int = 1):
 
 if __name__ == "__main__":
     process_domain(Constants.ROOT_DOMAIN, scanning_span=Constants.SCANNING_SPAN, starting_page=Constants.STARTING_PAGE)
+    converter.wait_for_conversions()
+    blobstore.collect_garbage_if_due()
@@ -1,9 +1,10 @@
 import random
 import traceback
 from datetime import datetime
-import requests
 from bs4 import BeautifulSoup
+import blobstore
 import common
+import converter
 import downloader
 
 
@@ -35,7 +36,7 @@ def __get_local_name(article_title: str, url: str, likes: str):
 
 
 def get_article_soup(url: str) -> BeautifulSoup:
-    session = requests.session()
+    session = common.get_session()
     soup = BeautifulSoup(session.get(url).text, common.Constants.HTML_PARSER)
     if not soup.select_one('div.article-body > div.text-muted'):
         # No need to configure proxy.
@@ -45,9 +46,10 @@ def get_article_soup(url: str) -> BeautifulSoup:
     free_proxy_list = common.get_free_proxies()
     for i, proxy in enumerate(free_proxy_list):
         try:
-            session.proxies = {'http': 'http://' + proxy,
-                               'https://': 'https://' + proxy}
-            soup = BeautifulSoup(session.get(url).text, common.Constants.HTML_PARSER)
+            # Per request, as the session is shared.
+            proxies = {'http': 'http://' + proxy,
+                       'https://': 'https://' + proxy}
+            soup = BeautifulSoup(session.get(url, proxies=proxies).text, common.Constants.HTML_PARSER)
             if not soup.select_one('div.article-body > div.text-muted'):
                 print('Proxy: %s worked.(trial %d)' % (proxy, i + 1))
                 return soup
@@ -97,6 +99,7 @@ def scan_article(url: str):
             downloader.iterate_source_tags(external_link_tags, local_name + '-a', url)
         except Exception as video_source_exception:
             log('Error: %s\n%s\n[Traceback]\n%s' % (video_source_exception, url, traceback.format_exc()))
+    downloader.wait_for_downloads()
 
 
 def get_entries_to_scan(placeholder: str, min_likes: int, scanning_span: int, page: int = 1) -> ():
@@ -107,7 +110,7 @@ def get_entries_to_scan(placeholder: str, min_likes: int, scanning_span: int, pa
     while page <= max_page and has_regular_row:  # Page-wise
         start_time = datetime.now()  # A timer for monitoring performance
         url = placeholder + str(page)
-        soup = BeautifulSoup(requests.get(url).text, common.Constants.HTML_PARSER)
+        soup = BeautifulSoup(common.get_session().get(url).text, common.Constants.HTML_PARSER)
         rows = soup.select('div.list-table > a.vrow')
         has_regular_row = False
 
@@ -181,4 +184,6 @@ def process_domain(domains: tuple, scanning_span: int, starting_page: int = 1):
 
 if __name__ == "__main__":
     process_domain(Constants.SUBDIRECTORIES, Constants.SCANNING_SPAN, Constants.STARTING_PAGE)
+    converter.wait_for_conversions()
+    blobstore.collect_garbage_if_due()
     log("Script finished.")
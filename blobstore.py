@@ -0,0 +1,86 @@
+import os
+import time
+import zipfile
+import common
+import filesink
+
+
+class Constants:
+    # On the same file system as the downloads, as the stored files are hardlinks to the blobs.
+    BLOB_PATH = os.path.join(common.Constants.DOWNLOAD_PATH, '.blobs')
+    # The blobs of the deleted files are removed when a crawler exits, once in this interval at most.
+    COLLECTION_INTERVAL = 24 * 60 * 60
+    COLLECTION_STAMP_PATH = os.path.join(common.Constants.DUMP_PATH, 'blobs_collected')  # Touched on each collection
+
+
+def get_blob_path(digest: str) -> str:
+    # The digest is the index: a lookup is a single stat. (e.g. .blobs/3f/3fa2...)
+    return os.path.join(Constants.BLOB_PATH, digest[:2], digest)
+
+
+def commit(temp_path: str, final_path: str, digest: str = None) -> bool:
+    # Move a complete file into place, as a hardlink to the identical one if stored before.
+    # Return True if the content was a duplicate, i.e. no new bytes have been kept.
+    if not digest:
+        digest = filesink.hash_file(temp_path)
+    blob_path = get_blob_path(digest)
+    try:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.link(temp_path, blob_path)  # The first copy becomes the blob.
+    except FileExistsError:  # A duplicate
+        link_path = final_path + '.link'
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.link(blob_path, link_path)
+        filesink.commit(link_path, final_path)
+        os.remove(temp_path)
+        print('Duplicate of %s: %s' % (digest[:12], final_path))
+        return True
+    except OSError as link_exception:  # Hardlinks not supported: store as a plain file.
+        print('Warning: cannot link the blob.(%s)' % link_exception)
+    filesink.commit(temp_path, final_path)
+    return False
+
+
+def extract(zip_ref: zipfile.ZipFile, member: zipfile.ZipInfo, destination_dir: str, file_name: str = None) -> str:
+    # Stream a zip member into the destination, hashing on the way. Return the stored path.
+    file_path = os.path.join(destination_dir, file_name if file_name else os.path.basename(member.filename))
+    temp_path = file_path + '.part'
+    with zip_ref.open(member) as source, filesink.FileSink(temp_path, length=member.file_size, is_hashed=True) as sink:
+        for data in iter(lambda: source.read(filesink.Constants.BUFFER_SIZE), b''):
+            sink.write(data)
+    commit(temp_path, file_path, sink.digest())
+    return file_path
+
+
+def collect_garbage() -> int:
+    # Remove the blobs no stored file links to anymore, e.g. deleted after reviewing.
+    removed = 0
+    for dir_path, _, file_names in os.walk(Constants.BLOB_PATH):
+        for file_name in file_names:
+            blob_path = os.path.join(dir_path, file_name)
+            if os.stat(blob_path).st_nlink <= 1:
+                os.remove(blob_path)
+                removed += 1
+    return removed
+
+
+def collect_garbage_if_due() -> int:
+    # Call at exit: a deleted file frees its space on the next collection only.
+    try:
+        last_collection_time = os.path.getmtime(Constants.COLLECTION_STAMP_PATH)
+    except OSError:  # Never collected
+        last_collection_time = 0
+    if time.time() - last_collection_time < Constants.COLLECTION_INTERVAL:
+        return 0
+    removed = collect_garbage()
+    common.check_dir_exists(os.path.dirname(Constants.COLLECTION_STAMP_PATH))
+    with open(Constants.COLLECTION_STAMP_PATH, 'w') as stamp:
+        stamp.write('%d\n' % removed)
+    if removed:
+        print('Removed %d orphan blobs.' % removed)
+    return removed
+
+
+if __name__ == "__main__":
+    print('Removed %d orphan blobs.' % collect_garbage())
@@ -0,0 +1,139 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+
+class Constants:
+    MAX_BROWSERS = 2  # Warm instances at once
+    MAX_USES = 50  # Articles per instance before recycling it
+    MAX_RSS_MB = 1536  # Of chromedriver, Chrome and its renderers altogether
+    BLANK_PAGE = 'about:blank'
+
+
+def __read_rss_pages(pid: str) -> int:
+    try:
+        with open('/proc/%s/statm' % pid) as statm:
+            return int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):  # Exited, or not Linux
+        return 0
+
+
+def get_tree_rss_mb(root_pid: int) -> float:
+    # The resident memory of a process and all its descendants, read from /proc.
+    children = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as stat:
+                ppid = stat.read().rsplit(')', 1)[1].split()[1]  # The name may contain spaces.
+        except (OSError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+
+    pages = 0
+    pending = [str(root_pid)]
+    while pending:
+        pid = pending.pop()
+        pages += __read_rss_pages(pid)
+        pending.extend(children.get(pid, []))
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class BrowserPool:
+    # Warm web drivers, reset between articles instead of starting Chrome over.
+    # factory: a function returning a new web driver. e.g. initiate_browser of each crawler
+    def __init__(self, factory, max_browsers: int = None, max_uses: int = None, max_rss_mb: float = None,
+                 is_keeping_cookies: bool = True):
+        self.factory = factory
+        self.max_uses = max_uses if max_uses else Constants.MAX_USES
+        self.max_rss_mb = max_rss_mb if max_rss_mb else Constants.MAX_RSS_MB
+        self.is_keeping_cookies = is_keeping_cookies  # e.g. to stay logged in
+        self.idle = queue.LifoQueue()  # The most recently used first: its caches are the warmest.
+        self.slots = threading.BoundedSemaphore(max_browsers if max_browsers else Constants.MAX_BROWSERS)
+        self.uses = {}
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            try:
+                driver = self.factory()
+            except Exception:
+                self.slots.release()
+                raise
+            with self.lock:
+                self.uses[id(driver)] = 0
+            return driver
+
+    def release(self, driver, is_broken: bool = False):
+        # Return the driver to the pool, or quit it if broken, worn out or bloated.
+        try:
+            with self.lock:
+                self.uses[id(driver)] = self.uses.get(id(driver), 0) + 1
+                uses = self.uses[id(driver)]
+            if is_broken or uses >= self.max_uses:
+                self.__quit(driver)
+                return
+            rss_mb = self.__get_rss_mb(driver)
+            if rss_mb > self.max_rss_mb:
+                print('Recycling a browser of %.0f MB after %d uses.' % (rss_mb, uses))
+                self.__quit(driver)
+            elif not self.__reset(driver):
+                self.__quit(driver)
+            else:
+                self.idle.put(driver)
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def browser(self):
+        driver = self.acquire()
+        is_broken = False
+        try:
+            yield driver
+        except Exception:
+            is_broken = True
+            raise
+        finally:
+            self.release(driver, is_broken)
+
+    def close(self):
+        while True:
+            try:
+                self.__quit(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def __reset(self, driver) -> bool:
+        # Close the pop-ups, then leave the page so that its scripts stop.
+        try:
+            handles = driver.window_handles
+            for handle in handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(handles[0])
+            if not self.is_keeping_cookies:  # Of the current domain: before leaving the page
+                driver.delete_all_cookies()
+            driver.get(Constants.BLANK_PAGE)
+            return True
+        except Exception as reset_exception:
+            print('Warning: cannot reset the browser.(%s)' % reset_exception)
+            return False
+
+    def __get_rss_mb(self, driver) -> float:
+        try:
+            return get_tree_rss_mb(driver.service.process.pid)
+        except Exception:  # Unknown: keep using it.
+            return 0
+
+    def __quit(self, driver):
+        with self.lock:
+            self.uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as quit_exception:
+            print('Warning: cannot quit the browser.(%s)' % quit_exception)
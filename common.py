@@ -1,11 +1,16 @@
 import random
+import threading
 import time
 
-from PIL import Image
 from datetime import datetime
 import os
 from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
+import converter
+
+__http_session = None  # Shared by every crawler module: see get_session()
+__http_session_lock = threading.Lock()
 
 
 def log(message: str, path: str, has_tst: bool = True):
@@ -37,6 +42,27 @@ def check_dir_exists(dir_path: str):
         return True  # Already exists.
 
 
+def set_download_directory(driver, dir_path: str):
+    # Send the downloads to a directory of their own, instead of the default directory of the browser.
+    # For the whole browser, pop-ups included. The pool hands a browser to one article at a time.
+    check_dir_exists(dir_path)
+    driver.execute_cdp_cmd('Browser.setDownloadBehavior',
+                           {'behavior': 'allow', 'downloadPath': os.path.abspath(dir_path)})
+
+
+def block_urls(driver, patterns: ()):
+    # Requests of the current tab to the matching urls fail without reaching the network. Empty to allow all.
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': list(patterns)})
+
+
+def remove_dir_if_empty(dir_path: str):
+    try:
+        os.rmdir(dir_path)
+    except OSError:  # Files left, or already removed
+        pass
+
+
 def read_from_file(path: str):
     with open(path) as f:
         return f.read().strip('\n')
@@ -54,7 +80,7 @@ def get_date_difference(tst_str: str) -> int:
 def get_free_proxies():
     url = "https://free-proxy-list.net/"
     # get the HTTP response and construct soup object
-    soup = BeautifulSoup(requests.get(url).content, "html.parser")
+    soup = BeautifulSoup(get_session().get(url).content, "html.parser")
     proxies = []
     for row in soup.select('div.fpl-list > table.table > tbody > tr'):
         tds = row.find_all("td")
@@ -68,9 +94,49 @@ def get_free_proxies():
     return proxies
 
 
+def build_session(proxies: dict = None) -> requests.Session:
+    # A keep-alive session with a connection pool per host and the default headers.
+    session = requests.session()
+    adapter = HTTPAdapter(pool_connections=Constants.HTTP_POOL_HOSTS, pool_maxsize=Constants.HTTP_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(Constants.HTTP_HEADERS)
+    if proxies:
+        session.proxies = proxies
+    return session
+
+
+def get_session() -> requests.Session:
+    # The process-wide session: the TCP and TLS setup happen once per host per run.
+    global __http_session
+    with __http_session_lock:
+        if __http_session is None:
+            __http_session = build_session()
+        return __http_session
+
+
+def build_session_from_driver(driver, proxies: dict = None) -> requests.Session:
+    # A session continuing that of the browser: the same cookies and user agent, without rendering pages.
+    session = build_session(proxies)
+    session.headers['User-Agent'] = driver.execute_script('return navigator.userAgent;')
+    copy_driver_cookies(driver, session)
+    return session
+
+
+def get_all_cookies(driver) -> []:
+    # Of every domain, unlike driver.get_cookies() which returns those of the current page only.
+    return driver.execute_cdp_cmd('Network.getAllCookies', {})['cookies']
+
+
+def copy_driver_cookies(driver, session: requests.Session):
+    # e.g. after logging in with the browser
+    for cookie in get_all_cookies(driver):
+        session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+
+
 def get_proxy_session(sampling_url: str, log_path: str = None):
     timeout = 3
-    session = requests.session()
+    session = build_session()
     try:
         code = session.get(sampling_url, timeout=timeout).status_code
         if code == 200:
@@ -90,15 +156,13 @@ def get_proxy_session(sampling_url: str, log_path: str = None):
                     return session
             except Exception as e:
                 print('%s failed.(%s)' % (proxy, e))
-    return requests.session()  # Try again with a normal session.
+    return build_session()  # Try again with a normal session.
 
 
 def get_tor_session():
-    req = requests.session()
     # Tor uses the 9050 port as the default socks port
-    req.proxies = {'http': 'socks5://127.0.0.1:9050',
-                   'https': 'socks5://127.0.0.1:9050'}
-    return req
+    return build_session({'http': 'socks5://127.0.0.1:9050',
+                          'https': 'socks5://127.0.0.1:9050'})
 
 
 def get_ip(session: requests.Session) -> str:
@@ -124,13 +188,11 @@ def get_elapsed_sec(start_time) -> float:
 
 
 def convert_webp_to_png(stored_dir, filename):
+    # Synchronously: see the converter module for converting off the download path.
     ext = 'png'
     stored_path = os.path.join(stored_dir, filename)
-    img = Image.open(stored_path).convert("RGB")
     new_filename = split_on_last_pattern(filename, '.')[0] + '.' + ext
-    new_path = os.path.join(stored_dir, new_filename)
-    img.save(new_path, ext)
-    os.remove(stored_path)
+    converter.convert_file(stored_path, os.path.join(stored_dir, new_filename))
 
 
 # Split on the pattern, but always returning a list with length of 2.
@@ -148,3 +210,18 @@ class Constants:
     DUMP_PATH = read_from_file('DUMP_PATH.pv')
     IGNORED_TITLE_PATTERNS = build_tuple('IGNORED_TITLE_PATTERNS.pv')
     PROHIBITED_CHARS = (' ', '.', '/')
+
+    # Resources never needed by the crawlers: fonts, ads and trackers
+    BLOCKED_URL_PATTERNS = ('*.woff', '*.woff2', '*.ttf', '*.otf', '*doubleclick.net*', '*googlesyndication.com*',
+                            '*google-analytics.com*', '*googletagmanager.com*', '*adservice.google.*')
+    # Needed only to be displayed: blocked while reading listing and auth pages
+    BLOCKED_MEDIA_PATTERNS = ('*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.svg', '*.ico',
+                              '*.mp4', '*.webm', '*.m3u8')
+    IMAGE_BLOCKING_PREFS = {'profile.managed_default_content_settings.images': 2}
+
+    # The shared HTTP client
+    HTTP_POOL_HOSTS = 32  # The number of hosts to keep a connection pool for
+    HTTP_POOL_SIZE = 8  # The connections kept alive per host
+    HTTP_PAGE_TIMEOUT = (10, 30)  # (connect, read) fetching a page without the browser
+    HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+                                  '(KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36'}
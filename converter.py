@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image
+
+
+class Constants:
+    MAX_WORKERS = os.cpu_count()
+    IN_MEMORY_LIMIT = 32 * 1024 * 1024  # Smaller downloads are converted from their bytes, without a temporary file.
+    MAX_PENDING_BYTES_SUBMISSIONS = 2 * MAX_WORKERS  # Submitting blocks beyond, to bound the memory.
+
+
+__executor = None
+__executor_lock = threading.Lock()
+__pending_count = 0  # Submitted, and not through their callbacks yet
+__pending_condition = threading.Condition()
+__bytes_slots = threading.BoundedSemaphore(Constants.MAX_PENDING_BYTES_SUBMISSIONS)
+
+
+def convert_file(stored_path: str, new_path: str):
+    with Image.open(stored_path) as img:
+        img.convert('RGB').save(new_path, 'png')
+    os.remove(stored_path)
+
+
+def convert_bytes(data: bytes, new_path: str):
+    with Image.open(BytesIO(data)) as img:
+        img.convert('RGB').save(new_path, 'png')
+
+
+def __get_executor() -> ProcessPoolExecutor:
+    global __executor
+    with __executor_lock:
+        if __executor is None:
+            # Spawned, not forked: the crawlers fork from threads holding locks.
+            __executor = ProcessPoolExecutor(max_workers=Constants.MAX_WORKERS,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return __executor
+
+
+def __submit(function, *args):
+    # The spawned workers import the main module of the parent: the crawlers guard their entry points.
+    global __pending_count
+    executor = __get_executor()
+    with __pending_condition:  # Counted before the callback can run
+        __pending_count += 1
+    try:
+        return executor.submit(function, *args)
+    except Exception:
+        with __pending_condition:
+            __pending_count -= 1
+            __pending_condition.notify_all()
+        raise
+
+
+def __track(future, on_converted, on_failed=None):
+    # on_converted() runs in the parent once the file is written, e.g. to move it into place.
+    # on_failed() runs instead if the conversion fails, e.g. to keep the source for the next run.
+    def callback(done_future):
+        global __pending_count
+        try:
+            done_future.result()
+            if on_converted:
+                on_converted()
+        except Exception as conversion_exception:
+            print('Error: conversion failed.(%s)\n[Traceback]\n%s' % (conversion_exception, traceback.format_exc()))
+            if on_failed:
+                on_failed()
+        finally:  # Only now is the conversion finished for wait_for_conversions().
+            with __pending_condition:
+                __pending_count -= 1
+                __pending_condition.notify_all()
+
+    future.add_done_callback(callback)
+    return future
+
+
+def submit_file(stored_path: str, new_path: str, on_converted=None, on_failed=None):
+    return __track(__submit(convert_file, stored_path, new_path), on_converted, on_failed)
+
+
+def submit_bytes(data: bytes, new_path: str, on_converted=None, on_failed=None):
+    __bytes_slots.acquire()
+    try:
+        future = __submit(convert_bytes, data, new_path)
+    except Exception:
+        __bytes_slots.release()
+        raise
+    future.add_done_callback(lambda _: __bytes_slots.release())
+    return __track(future, on_converted, on_failed)
+
+
+def wait_for_conversions():
+    # Block until every submitted conversion has finished and gone through its callback, e.g. before the script exits.
+    with __pending_condition:
+        while __pending_count > 0:
+            __pending_condition.wait()
@@ -1,5 +1,5 @@
 import os
-import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 import selenium.common.exceptions
@@ -9,8 +9,16 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions
 from selenium.webdriver.support.wait import WebDriverWait
 
+import blobstore
+import browserpool
 import common
+import converter
+import devtools
+import filesink
+import ingest
+import perceptual
 import random
+import sessioncache
 import traceback
 from datetime import datetime
 from bs4 import BeautifulSoup
@@ -23,6 +31,36 @@ class Constants:
     TOO_OLD_DAY = 3
     SCANNING_SPAN = 30
     STARTING_PAGE = 1
+    SITE = 'dc'
+    IS_FETCHING_PAGES_OVER_HTTP = True  # With the cookies of the browser, which is used only behind the auth wall
+    AUTH_WALL_CLASS_NAME = 'adult_certify'
+    # Blocked by the browser: on listing and auth pages, and on article pages with the download buttons
+    BLOCKED_URL_PATTERNS = common.Constants.BLOCKED_URL_PATTERNS + common.Constants.BLOCKED_MEDIA_PATTERNS
+    DOWNLOAD_PAGE_BLOCKED_URL_PATTERNS = common.Constants.BLOCKED_URL_PATTERNS
+    IS_LOADING_IMAGES = False  # Images are saved by the download buttons, not rendered.
+
+    # Run in the browser: only the fields read are sent back, instead of the whole page source.
+    ROW_SELECTOR = 'table.gall_list > tbody > tr.us-post'
+    ROW_EXTRACTION_SCRIPT = '''
+        function text(row, selector) { var tag = row.querySelector(selector); return tag ? tag.textContent : null; }
+        return Array.from(document.querySelectorAll(arguments[0])).map(function (row) {
+            var date = row.querySelector('td.gall_date'), link = row.querySelector('td.gall_tit > a');
+            return {subject: text(row, 'td.gall_subject'), num: text(row, 'td.gall_num'),
+                    likes: text(row, 'td.gall_recommend'), date: date ? date.getAttribute('title') : null,
+                    title: link ? link.textContent : null, href: link ? link.getAttribute('href') : null,
+                    no: row.getAttribute('data-no')};
+        });'''
+    ARTICLE_EXTRACTION_SCRIPT = '''
+        var likes = document.querySelector('div.fr > span.gall_reply_num');
+        var title = document.querySelector('h3.title > span.title_subject');
+        return {likes: likes ? likes.textContent : null, title: title ? title.textContent : null};'''
+
+    # Fetch the attachments directly, instead of through the download buttons of the browser.
+    IS_FETCHING_DIRECTLY = True
+    MAX_CONCURRENT_ATTACHMENTS = 4  # Per article
+    ATTACHMENT_EXTRACTION_SCRIPT = '''
+        return Array.from(document.querySelectorAll('div.appending_file_box ul.appending_file > li a')).map(
+            function (link) { return {name: link.textContent.trim(), url: link.href}; });'''
 
     EXTENSION_CANDIDATES = ('jpg', 'jpeg', 'png', 'gif', 'jfif', 'webp', 'mp4', 'webm', 'mov')
     TITLE_WHITELIST = common.build_tuple('DC_TITLE_WHITELIST.pv')
@@ -55,13 +93,18 @@ def initiate_browser():
     # A Chrome web driver with headless option
     # service = Service(common.Constants.DRIVER_PATH)
     options = webdriver.ChromeOptions()
-    options.add_experimental_option("prefs", {
+    prefs = {
         "download.default_directory": Constants.TMP_DOWNLOAD_PATH,
         "download.prompt_for_download": False
-    })
+    }
+    if not Constants.IS_LOADING_IMAGES:
+        prefs.update(common.Constants.IMAGE_BLOCKING_PREFS)
+    options.add_experimental_option("prefs", prefs)
     options.add_argument('headless')
     # options.add_argument('disable-gpu')
     driver = webdriver.Chrome(executable_path=common.Constants.DRIVER_PATH, options=options)
+    common.block_urls(driver, Constants.BLOCKED_URL_PATTERNS)
+    sessioncache.restore_to_driver(Constants.SITE, driver)  # Logged in already, unless rejected
     return driver
 
 
@@ -111,9 +154,15 @@ def scan_article(url: str) -> bool:
     log('\nProcessing %s' % url)
     domain_tag = 'dc'
 
-    # A temporary folder to store the zip file.
+    # A temporary folder to store the zip file, of the article only.
     # The folder name can be anything, but use the article number to prevent duplicate names.
-    common.check_dir_exists(Constants.TMP_DOWNLOAD_PATH)
+    download_path = Constants.TMP_DOWNLOAD_PATH + __get_no_from_url(url) + '/'
+    tracker = devtools.get_tracker(browser)
+    if tracker:  # With the download events
+        tracker.set_download_path(download_path)
+    else:
+        common.set_download_directory(browser, download_path)
+    common.block_urls(browser, Constants.DOWNLOAD_PAGE_BLOCKED_URL_PATTERNS)  # Whatever the buttons request
 
     # Load the article.
     start_time = datetime.now()
@@ -126,12 +175,12 @@ def scan_article(url: str) -> bool:
 
     # Get the information to format the file name.
     try:
-        soup = BeautifulSoup(browser.page_source, common.Constants.HTML_PARSER)
+        article_info = browser.execute_script(Constants.ARTICLE_EXTRACTION_SCRIPT)
         # Get Likes.
-        likes = soup.select_one('div.fr > span.gall_reply_num').string.strip().split(' ')[-1]
+        likes = article_info['likes'].strip().split(' ')[-1]
         formatted_likes = '%03d' % int(likes)
         # Get the title.
-        article_title = soup.select_one('h3.title > span.title_subject').string
+        article_title = article_info['title']
         formatted_title = article_title.strip()
         log('<%s> Loaded.' % formatted_title)
         for prohibited_char in common.Constants.PROHIBITED_CHARS:
@@ -146,59 +195,129 @@ def scan_article(url: str) -> bool:
         # Use the article number as the file name.
         formatted_file_name = domain_tag + '-' + __get_no_from_url(url)
 
-    download_successful = click_download_button(url, Constants.TMP_DOWNLOAD_PATH, loading_sec)
+    download_successful = False
+    if Constants.IS_FETCHING_DIRECTLY:
+        attachments = browser.execute_script(Constants.ATTACHMENT_EXTRACTION_SCRIPT)
+        if attachments:
+            download_successful = fetch_attachments(attachments, url, download_path)
+        if not download_successful:
+            log('Warning: Cannot fetch the attachments directly. Try the download buttons.')
+            for file_name in os.listdir(download_path):  # Not to be mixed with the files of the buttons
+                os.remove(download_path + file_name)
+    if not download_successful:
+        download_successful = click_download_button(url, download_path, loading_sec)
 
     if not download_successful:  # Timeout reached again. Log and move to the next article.
         log('Error: Download failed.')
-        if len(os.listdir(Constants.TMP_DOWNLOAD_PATH)) > 0:
-            mark_and_move(Constants.TMP_DOWNLOAD_PATH, Constants.DESTINATION_PATH)
+        if len(os.listdir(download_path)) > 0:
+            mark_and_move(download_path, Constants.DESTINATION_PATH)
             log('Error: Files left after download failure.')
+        common.remove_dir_if_empty(download_path)
         return False
 
     try:
-        __format_downloaded_file(formatted_file_name)
+        __format_downloaded_file(formatted_file_name, download_path)
+        common.remove_dir_if_empty(download_path)
         return True
     except Exception as post_download_exception:
         log('Error: cannot process downloaded files.(%s)' % post_download_exception)
         return False
 
 
+def fetch_attachments(attachments: [], referer: str, download_path: str) -> bool:
+    # attachments: [{'name': name, 'url': url}, ...] from ATTACHMENT_EXTRACTION_SCRIPT
+    # Stored in the download folder of the article under the names the buttons would give them.
+    session = __get_page_session()
+    common.copy_driver_cookies(browser, session)  # Those of the article page as well
+    file_names = __get_unique_names([os.path.basename(attachment['name']) or '%02d' % i
+                                     for i, attachment in enumerate(attachments)])
+    with ThreadPoolExecutor(max_workers=Constants.MAX_CONCURRENT_ATTACHMENTS,
+                            thread_name_prefix='attachment') as executor:
+        futures = [executor.submit(__fetch_attachment, session, attachment['url'], referer, download_path + file_name)
+                   for attachment, file_name in zip(attachments, file_names)]
+    failures = [future.exception() for future in futures if future.exception()]
+    if failures:
+        log('Warning: %d of %d attachments failed.(%s)' % (len(failures), len(futures), failures[0]))
+        return False
+    return True
+
+
+def __get_unique_names(file_names: []) -> []:
+    # The same name again gets a number, as Chrome would name it. (e.g. image.jpg, image (1).jpg, ...)
+    unique_names = []
+    for file_name in file_names:
+        stem, extension = common.split_on_last_pattern(file_name, '.') if '.' in file_name else (file_name, '')
+        unique_name = file_name
+        n = 1
+        while unique_name in unique_names:
+            unique_name = '%s (%d)' % (stem, n) + ('.' + extension if extension else '')
+            n += 1
+        unique_names.append(unique_name)
+    return unique_names
+
+
+def __fetch_attachment(session, url: str, referer: str, file_path: str):
+    with session.get(url, headers={'Referer': referer}, stream=True,
+                     timeout=downloader.Constants.DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with filesink.FileSink(file_path + '.part') as sink:
+            for chunk in response.iter_content(downloader.Constants.CHUNK_SIZE):
+                sink.write(chunk)
+    filesink.commit(file_path + '.part', file_path)
+
+
 # Process the downloaded file. (Mostly, a zip file or an image)
-def __format_downloaded_file(formatted_file_name):
-    # Unzip the downloaded file.
-    zip_files = glob(Constants.TMP_DOWNLOAD_PATH + '*.zip')
+def __format_downloaded_file(formatted_file_name: str, download_path: str):
+    destination_head = Constants.DESTINATION_PATH + formatted_file_name
+
+    # Unzip the downloaded file: each member is written once, under its final name.
+    zip_files = glob(download_path + '*.zip')
     for zip_file_path in zip_files:
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(Constants.TMP_DOWNLOAD_PATH)
+        ingest.ingest_zip(zip_file_path, lambda stored_name: __get_destination_path(destination_head, stored_name),
+                          perceptual.screen)
         os.remove(zip_file_path)
 
-    # Convert webp files.
-    for file_name in os.listdir(Constants.TMP_DOWNLOAD_PATH):  # The file name might have been changed.
-        if file_name.endswith('.webp'):
-            common.convert_webp_to_png(Constants.TMP_DOWNLOAD_PATH, file_name)
+    # Move the files downloaded as they are. An identical file stored before is linked instead.
+    for file_name in os.listdir(download_path):
+        if file_name.endswith('.webp'):  # Out of the temporary folder, then convert off the download path.
+            destination_path = __get_destination_path(destination_head,
+                                                      common.split_on_last_pattern(file_name, '.')[0] + '.png')
+            os.rename(download_path + file_name, destination_path + '.webp.part')
+            converter.submit_file(destination_path + '.webp.part', destination_path + '.part',
+                                  lambda path=destination_path: __store_converted(path + '.part', path))
+        else:
+            destination_path = __get_destination_path(destination_head, file_name)
+            blobstore.commit(download_path + file_name, destination_path)
+            perceptual.screen(destination_path)
 
-    # Rename files with long names.
-    destination_head = Constants.DESTINATION_PATH + formatted_file_name
+
+def __get_destination_path(destination_head: str, stored_name: str) -> str:
+    # Truncate long file names.
     char_limit = 40
-    for file_name in os.listdir(Constants.TMP_DOWNLOAD_PATH):
-        if len(file_name) > char_limit:
-            print('Truncated a long file name: %s' % file_name)
-            os.rename(Constants.TMP_DOWNLOAD_PATH + file_name, destination_head + file_name[-char_limit:])
-        else:
-            os.rename(Constants.TMP_DOWNLOAD_PATH + file_name, destination_head + file_name)
+    if len(stored_name) > char_limit:
+        print('Truncated a long file name: %s' % stored_name)
+        return destination_head + stored_name[-char_limit:]
+    return destination_head + stored_name
+
+
+def __store_converted(temp_path: str, file_path: str):
+    blobstore.commit(temp_path, file_path)
+    perceptual.screen(file_path)
 
 
 def check_auth(url):
-    certify_class_name = 'adult_certify'
+    certify_class_name = Constants.AUTH_WALL_CLASS_NAME
     if not element_exists_by_class(browser, certify_class_name):
         # Login not required.
         return True  # Good to go.
     else:
+        sessioncache.invalidate(Constants.SITE)  # The cached session, if any, has been rejected.
         for i in range(2):
             log('Login required to access the article.')
             try:
                 is_logged_in = login(browser, url)
                 if is_logged_in and not element_exists_by_class(browser, certify_class_name):
+                    sessioncache.save(Constants.SITE, browser)
                     return True  # Good to go.
             except Exception as login_exception:
                 log('Authentication failed.(%s)' % login_exception)
@@ -206,20 +325,72 @@ def check_auth(url):
             return False  # Cannot proceed.
 
 
+def __get_page_session():
+    global page_session
+    if page_session is None:
+        page_session = common.build_session_from_driver(browser)
+    return page_session
+
+
+def __extract_rows(soup: BeautifulSoup) -> []:
+    # The same fields as ROW_EXTRACTION_SCRIPT, from a page fetched without the browser
+    def text(row, selector: str):
+        tag = row.select_one(selector)
+        return tag.get_text() if tag else None
+
+    rows = []
+    for row in soup.select(Constants.ROW_SELECTOR):
+        date_tag = row.select_one('td.gall_date')
+        link_tag = row.select_one('td.gall_tit > a')
+        rows.append({'subject': text(row, 'td.gall_subject'), 'num': text(row, 'td.gall_num'),
+                     'likes': text(row, 'td.gall_recommend'), 'date': date_tag.get('title') if date_tag else None,
+                     'title': link_tag.get_text() if link_tag else None,
+                     'href': link_tag.get('href') if link_tag else None, 'no': row.get('data-no')})
+    return rows
+
+
+def load_rows(url: str):
+    # Return (the rows of the listing page, the url after redirects), or (None, url) if not accessible.
+    if Constants.IS_FETCHING_PAGES_OVER_HTTP:
+        try:
+            response = __get_page_session().get(url, timeout=common.Constants.HTTP_PAGE_TIMEOUT)
+            if response.status_code == 200:
+                soup = BeautifulSoup(response.text, common.Constants.HTML_PARSER)
+                if not soup.select_one('.' + Constants.AUTH_WALL_CLASS_NAME):
+                    return __extract_rows(soup), response.url
+                print('Login required: loading %s with the browser.' % url)
+            else:
+                print('Warning: HTTP response %d. Loading %s with the browser.' % (response.status_code, url))
+        except Exception as http_exception:
+            print('Warning: cannot fetch %s.(%s)' % (url, http_exception))
+
+    common.block_urls(browser, Constants.BLOCKED_URL_PATTERNS)
+    browser.get(url)
+    if not check_auth(url):
+        return None, url
+    common.copy_driver_cookies(browser, __get_page_session())  # Logged in for the next fetches.
+    return browser.execute_script(Constants.ROW_EXTRACTION_SCRIPT, Constants.ROW_SELECTOR), browser.current_url
+
+
 def click_download_button(url: str, tmp_download_path: str, loading_sec: float) -> bool:
     # The download buttons
     btn_class_name = 'btn_file_dw'
     single_download_btn_xpath_1 = '//*[@id="container"]/section/article[2]/div[1]/div/div[7]/ul/li/a'
     single_download_btn_xpath_2 = '//*[@id="container"]/section/article[2]/div[1]/div/div[6]/ul/li/a'
+    # The download events of the browser, if its DevTools can be reached: no polling.
+    tracker = devtools.get_tracker(browser)
 
     for i in range(3):
+        if tracker:
+            tracker.reset()
         try:
             if i > 0:  # Has failed. Refresh the browser.
                 log('Download failed with trial #%d.' % i)
                 browser.get(url)  # refresh() does not wait the page to be loaded. So, use get(url)  instead.
             browser.find_element(By.CLASS_NAME, btn_class_name).click()
             print('"Download all" button located.')
-            successful = downloader.wait_finish_downloading(tmp_download_path, Constants.LOG_PATH, loading_sec, trial=i)
+            successful = downloader.wait_finish_downloading(tmp_download_path, Constants.LOG_PATH, loading_sec,
+                                                            trial=i, site=Constants.SITE, tracker=tracker)
             if successful:  # Without reaching timeout
                 break
             # Else, loop again.
@@ -229,8 +400,8 @@ def click_download_button(url: str, tmp_download_path: str, loading_sec: float)
                 print('Download button 1 located.')
 
                 # Don't wait as the session has waited long enough.
-                successful = downloader.wait_finish_downloading(tmp_download_path, Constants.LOG_PATH,
-                                                                loading_sec, trial=i)
+                successful = downloader.wait_finish_downloading(tmp_download_path, Constants.LOG_PATH, loading_sec,
+                                                                trial=i, site=Constants.SITE, tracker=tracker)
                 if successful:
                     break
             except selenium.common.exceptions.NoSuchElementException:
@@ -239,7 +410,8 @@ def click_download_button(url: str, tmp_download_path: str, loading_sec: float)
                     print('Download button 2 located.')
 
                     successful = downloader.wait_finish_downloading(tmp_download_path, Constants.LOG_PATH,
-                                                                    loading_sec, trial=i)
+                                                                    loading_sec, trial=i, site=Constants.SITE,
+                                                                    tracker=tracker)
                     if successful:
                         break
                 except selenium.common.exceptions.NoSuchElementException:
@@ -270,19 +442,19 @@ def __get_chan_from_url(url: str) -> str:
     return url.split('id=')[-1].split('&')[0]
 
 
-def qualify_row(row, row_no: int, min_likes: int, ignored_row_types: (), excluding: bool):
-    row_type_tag = row.select_one('td.gall_subject')
-    if row_type_tag:  # (214, 설문), (23124, 방송), (23125, 코스프), ...
-        if row_type_tag.string in ignored_row_types:
+def qualify_row(row: dict, row_no: int, min_likes: int, ignored_row_types: (), excluding: bool):
+    # row: the fields of ROW_EXTRACTION_SCRIPT
+    if row['subject'] is not None:  # (214, 설문), (23124, 방송), (23125, 코스프), ...
+        if row['subject'].strip() in ignored_row_types:
             return   # Skip the row.
     else:  # 설문, 공지, 21231, 21232, ...
-        article_no = str(row.select_one('td.gall_num').string)
+        article_no = str(row['num']).strip()
         if not article_no.isdigit():
             return  # Skip the row.
-    likes = int(row.select_one('td.gall_recommend').string)
+    likes = int(row['likes'])
 
     # 1. Filter by the date.
-    tst_str = row.select_one('td.gall_date')['title'].split(' ')[0]  # 2021-09-19 23:47:42
+    tst_str = row['date'].split(' ')[0]  # 2021-09-19 23:47:42
     day_diff = __get_date_difference(tst_str)
     if day_diff:
         if day_diff <= Constants.TOO_YOUNG_DAY:  # Still, not mature: uploaded on the yesterday.
@@ -298,7 +470,7 @@ def qualify_row(row, row_no: int, min_likes: int, ignored_row_types: (), excludi
     # 2. Filter by the title.
     # Retrieve the title.
     try:
-        title = row.select_one('td.gall_tit > a').text
+        title = row['title'].strip()
     except Exception as title_exception:
         title = '%05d' % random.randint(1, 99999)
         log('Error: cannot retrieve article title of row %d.(%s)' %
@@ -322,11 +494,10 @@ def qualify_row(row, row_no: int, min_likes: int, ignored_row_types: (), excludi
             if likes < min_likes:
                 return
 
-    try:
-        article_no = row['data-no']
-    except Exception as row_link_exception:
-        log('Warning: Cannot retrieve article number. Try extracting from url.(%s)' % row_link_exception)
-        article_no = __get_no_from_url(row.select_one('td.gall_tit > a')['href'])
+    article_no = row['no']
+    if not article_no:
+        log('Warning: Cannot retrieve article number. Try extracting from url.')
+        article_no = __get_no_from_url(row['href'])
     log('#%02d (%02d) \t| %s' % (row_no, likes, title), False)
     return article_no
 
@@ -341,12 +512,9 @@ def get_entries_to_scan(placeholder: str, min_likes: int, scanning_span: int,
     while page <= max_page:  # Page-wise
         start_time = datetime.now()  # A timer for monitoring performance
         url = placeholder.replace('%d', str(page))
-        browser.get(url)
-        is_accessible = check_auth(url)
-        if not is_accessible:
+        rows, current_url = load_rows(url)
+        if rows is None:  # Not accessible
             return tuple(to_scan)
-        soup = BeautifulSoup(browser.page_source, common.Constants.HTML_PARSER)
-        rows = soup.select('table.gall_list > tbody > tr.us-post')
 
         for i, row in enumerate(rows):  # Inspect the rows
             try:
@@ -363,11 +531,11 @@ def get_entries_to_scan(placeholder: str, min_likes: int, scanning_span: int,
             except Exception as row_exception:
                 log('Error: cannot process row %d from %s.(%s)' % (i + 1, url, row_exception))
                 continue
-        if browser.current_url == prev_url:
+        if current_url == prev_url:
             log('Page %d does not exists. Skip the following pages.' % page)
             return tuple(to_scan)
         else:
-            prev_url = browser.current_url  # Store the url for the next comparison.
+            prev_url = current_url  # Store the url for the next comparison.
         log('Page %d took %.1f".' % (page, common.get_elapsed_sec(start_time)), False)
         common.pause_briefly(1, 4)
         page += 1
@@ -401,7 +569,9 @@ def process_domain(gall: str, min_likes: int, scanning_span: int, starting_page:
 
 
 if __name__ == "__main__":
-    browser = initiate_browser()
+    browser_pool = browserpool.BrowserPool(initiate_browser)  # Cookies kept: stay logged in.
+    browser = browser_pool.acquire()
+    page_session = None  # Built from the browser on the first use
     failed_list = []
     try:
         for subdirectory, min_likes_str in Constants.SUBDIRECTORIES_CHAOTIC:
@@ -411,7 +581,10 @@ if __name__ == "__main__":
             process_domain(subdirectory, min_likes=int(min_likes_str),
                            scanning_span=Constants.SCANNING_SPAN, starting_page=Constants.STARTING_PAGE)
     finally:
-        browser.quit()
+        browser_pool.release(browser)
+        browser_pool.close()
+        converter.wait_for_conversions()
+        blobstore.collect_garbage_if_due()
         if failed_list:
             log("The followings have not been downloaded:", has_tst=False)
             for failed in failed_list:
@@ -0,0 +1,218 @@
+import itertools
+import json
+import os
+import threading
+import time
+from urllib.request import urlopen
+import common
+
+try:
+    import websocket  # websocket-client
+except ImportError:  # Wait by polling instead.
+    websocket = None
+
+
+class Constants:
+    CONNECT_TIMEOUT = 10
+    COMMAND_TIMEOUT = 30
+    PROGRESS_BINDING = '__accrProgress'
+    # Reports the attributes of the element on each change through the binding: formatted with (id, binding).
+    PROGRESS_OBSERVER_SCRIPT = '''(function () {
+        var bar = document.getElementById('%s');
+        if (!bar) {
+            return false;
+        }
+        function report() {
+            window.%s(JSON.stringify({style: bar.getAttribute('style') || '',
+                                      value: bar.getAttribute('aria-valuenow')}));
+        }
+        new MutationObserver(report).observe(bar, {attributes: true, attributeFilter: ['style', 'aria-valuenow']});
+        report();
+        return true;
+    })()'''
+
+
+__trackers = {}  # By the session id of the web driver
+__trackers_lock = threading.Lock()
+
+
+def is_supported() -> bool:
+    return websocket is not None
+
+
+def get_tracker(driver):
+    # The tracker of the browser, None if its DevTools cannot be reached.
+    if not is_supported():
+        return None
+    with __trackers_lock:
+        tracker = __trackers.get(driver.session_id)
+        if tracker is None or tracker.is_closed:
+            for session_id in [key for key, value in __trackers.items() if value.is_closed]:
+                del __trackers[session_id]  # Of the browsers quit
+            try:
+                tracker = DownloadTracker(driver)
+            except Exception as connect_exception:
+                print('Warning: cannot connect to the DevTools.(%s)' % connect_exception)
+                return None
+            __trackers[driver.session_id] = tracker
+        elif tracker.target_id != driver.current_window_handle:  # Another tab, e.g. after the pool has reset it
+            try:
+                tracker.attach(driver.current_window_handle)
+            except Exception as attach_exception:
+                print('Warning: cannot attach to the tab.(%s)' % attach_exception)
+                return None
+        return tracker
+
+
+class DownloadTracker:
+    # The download and progress events of a browser, over a DevTools connection of its own.
+    # The waits wake up on the events: completion, progress and stalls are known as they happen.
+    def __init__(self, driver):
+        address = driver.capabilities['goog:chromeOptions']['debuggerAddress']
+        with urlopen('http://%s/json/version' % address, timeout=Constants.CONNECT_TIMEOUT) as response:
+            url = json.load(response)['webSocketDebuggerUrl']
+        self.socket = websocket.create_connection(url, timeout=Constants.CONNECT_TIMEOUT, suppress_origin=True)
+        self.socket.settimeout(None)  # The reader blocks until the next message.
+        self.ids = itertools.count(1)
+        self.send_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.replies = {}
+        self.downloads = {}  # guid: {'name', 'state', 'received', 'total'}
+        self.progress = None  # The last report of the progress bar
+        self.has_progress_started = False
+        self.is_closed = False
+        threading.Thread(target=self.__read, name='devtools', daemon=True).start()
+
+        self.target_id = None
+        self.page_session = None
+        self.attach(driver.current_window_handle)
+
+    def attach(self, target_id: str):
+        # The tab of the driver, attached in a session of its own: its messages come through the same socket.
+        # (The window handles of chromedriver are the target ids.)
+        page_session = self.send('Target.attachToTarget', {'targetId': target_id, 'flatten': True})['sessionId']
+        self.send('Runtime.addBinding', {'name': Constants.PROGRESS_BINDING}, page_session)
+        if self.page_session:  # Of the previous tab, if still open
+            try:
+                self.send('Target.detachFromTarget', {'sessionId': self.page_session})
+            except RuntimeError:
+                pass
+        self.target_id, self.page_session = target_id, page_session
+
+    def send(self, method: str, params: dict = None, session_id: str = None) -> dict:
+        message = {'id': next(self.ids), 'method': method, 'params': params if params else {}}
+        if session_id:
+            message['sessionId'] = session_id
+        with self.send_lock:
+            self.socket.send(json.dumps(message))
+
+        deadline = time.time() + Constants.COMMAND_TIMEOUT
+        with self.condition:
+            while message['id'] not in self.replies:
+                if self.is_closed:
+                    raise ConnectionError('DevTools connection closed.')
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError('No reply to %s.' % method)
+                self.condition.wait(remaining)
+            reply = self.replies.pop(message['id'])
+        if 'error' in reply:
+            raise RuntimeError('%s failed.(%s)' % (method, reply['error'].get('message')))
+        return reply.get('result', {})
+
+    def __read(self):
+        try:
+            while True:
+                message = json.loads(self.socket.recv())
+                with self.condition:
+                    if 'id' in message:
+                        self.replies[message['id']] = message
+                    else:
+                        self.__handle(message.get('method'), message.get('params', {}))
+                    self.condition.notify_all()
+        except Exception:  # The browser has quit.
+            pass
+        finally:
+            with self.condition:
+                self.is_closed = True
+                self.condition.notify_all()
+
+    def __handle(self, method: str, params: dict):
+        if method == 'Browser.downloadWillBegin':
+            self.downloads[params['guid']] = {'name': params.get('suggestedFilename'), 'state': 'inProgress',
+                                              'received': 0, 'total': 0}
+            print('Download began: %s' % params.get('suggestedFilename'))
+        elif method == 'Browser.downloadProgress':
+            download = self.downloads.setdefault(params['guid'], {'name': None, 'state': 'inProgress',
+                                                                  'received': 0, 'total': 0})
+            if params['receivedBytes'] == download['received'] and params['state'] == download['state']:
+                return  # No progress
+            download.update({'state': params['state'], 'received': params['receivedBytes'],
+                             'total': params['totalBytes']})
+        elif method == 'Runtime.bindingCalled' and params.get('name') == Constants.PROGRESS_BINDING:
+            progress = json.loads(params['payload'])
+            if progress == self.progress:
+                return
+            self.progress = progress
+            if not progress['style']:  # Shown: the script is running.
+                self.has_progress_started = True
+
+    def reset(self):
+        # Forget the downloads and the progress so far: call before clicking.
+        with self.condition:
+            self.downloads.clear()
+            self.progress = None
+            self.has_progress_started = False
+
+    def set_download_path(self, dir_path: str):
+        # For the whole browser, with the events enabled. The pool hands a browser to one article at a time.
+        common.check_dir_exists(dir_path)
+        self.send('Browser.setDownloadBehavior',
+                  {'behavior': 'allow', 'downloadPath': os.path.abspath(dir_path), 'eventsEnabled': True})
+
+    def watch_progress(self, element_id: str) -> bool:
+        # Have the page report the changes of the progress bar. Return False if there is no such element.
+        result = self.send('Runtime.evaluate', {'expression': Constants.PROGRESS_OBSERVER_SCRIPT %
+                                                              (element_id, Constants.PROGRESS_BINDING),
+                                                'returnByValue': True}, self.page_session)
+        return result.get('result', {}).get('value') is True
+
+    def wait_for_progress(self, clock) -> bool:
+        # Return True once the progress bar has been shown, then hidden again: the script has finished.
+        # clock: the throughput.TransferClock of the wait, the progress counting from the bar shown
+        return self.__wait(lambda: True if self.has_progress_started and self.progress['style'] else None,
+                           lambda: (self.progress['value'] or 0, None) if self.has_progress_started else (None, None),
+                           clock)
+
+    def wait_for_downloads(self, clock) -> bool:
+        # Return True once every download begun has completed, False if any is canceled, stalls or times out.
+        def get_state():
+            states = [download['state'] for download in self.downloads.values()]
+            if 'canceled' in states:
+                print('Warning: Download canceled.')
+                return False
+            if states and all(state == 'completed' for state in states):
+                return True
+            return None
+
+        def get_progress():
+            received = sum(download['received'] for download in self.downloads.values())
+            totals = [download['total'] for download in self.downloads.values()]
+            return received if received else None, sum(totals) if totals and all(totals) else None
+        return self.__wait(get_state, get_progress, clock)
+
+    def __wait(self, get_state, get_progress, clock) -> bool:
+        # get_state() -> True: done, False: failed, None: not yet. get_progress() -> (received, total) for the clock.
+        # Both called on each event, holding the condition.
+        with self.condition:
+            while not self.is_closed:
+                state = get_state()
+                if state is not None:
+                    return state
+                clock.update(*get_progress())
+                failure = clock.get_failure()
+                if failure:
+                    print(failure)
+                    return False
+                self.condition.wait(clock.get_wait_sec())
+        return False
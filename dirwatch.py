@@ -0,0 +1,102 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+
+class Constants:
+    # Chrome writes into these, then renames them to the final name.
+    PARTIAL_SUFFIXES = ('.crdownload',)
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len: followed by the name of len bytes
+
+__libc = None
+
+
+def __get_libc():
+    global __libc
+    if __libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            __libc = libc if hasattr(libc, 'inotify_init1') else False
+        except OSError:
+            __libc = False
+    return __libc
+
+
+def is_supported() -> bool:
+    # inotify is Linux only.
+    return bool(__get_libc())
+
+
+def is_partial(file_name: str) -> bool:
+    return file_name.endswith(Constants.PARTIAL_SUFFIXES)
+
+
+def is_complete(dir_path: str) -> bool:
+    # A final file has landed, and nothing is being written anymore.
+    file_names = os.listdir(dir_path)
+    return any(not is_partial(name) for name in file_names) and not any(is_partial(name) for name in file_names)
+
+
+def __parse_events(data: bytes):
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        _, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset:offset + name_length].rstrip(b'\0').decode(errors='replace')
+        offset += name_length
+        yield name, mask
+
+
+def get_size(dir_path: str) -> int:
+    # Of the files written so far, partial ones included
+    size = 0
+    for file_name in os.listdir(dir_path):
+        try:
+            size += os.path.getsize(os.path.join(dir_path, file_name))
+        except OSError:  # Renamed meanwhile
+            pass
+    return size
+
+
+def wait_for_completion(dir_path: str, clock) -> bool:
+    # Return True as soon as a final file lands in dir_path with no partial one left,
+    # False once the clock gives up. clock: the throughput.TransferClock of the wait, fed with the bytes written
+    libc = __get_libc()
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    try:
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(dir_path), mask) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % dir_path)
+        if is_complete(dir_path):  # Landed before watching
+            return True
+
+        while True:
+            size = get_size(dir_path)
+            clock.update(size if size else None)
+            failure = clock.get_failure()
+            if failure:
+                print(failure)
+                return False
+            readable, _, _ = select.select([fd], [], [], clock.get_wait_sec())
+            if not readable:
+                continue
+            for name, mask in __parse_events(os.read(fd, 64 * 1024)):
+                if mask & IN_CREATE and is_partial(name):
+                    print('Downloading %s' % name)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and not is_partial(name) and is_complete(dir_path):
+                    print('Landed: %s' % name)
+                    return True
+    finally:
+        os.close(fd)
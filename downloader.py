@@ -1,11 +1,53 @@
+import itertools
+import json
 import os
+import threading
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
 from glob import glob
+from urllib.parse import urlparse
+import blobstore
 import common
+import converter
+import dirwatch
+import throughput
+import filesink
+import ledger
+import perceptual
 import requests
 
 
+class Constants:
+    # The download engine: the whole pool, and the share of a single host in it
+    MAX_CONCURRENT_DOWNLOADS = 8
+    MAX_CONCURRENT_DOWNLOADS_PER_HOST = 3
+
+    # A single download: interrupted ones resume from the .part file.
+    DOWNLOAD_RETRIES = 3
+    DOWNLOAD_TIMEOUT = (10, 60)  # (connect, read) in seconds
+    CHUNK_SIZE = 64 * 1024  # Buffered further by the file sink
+    CHECKPOINT_SIZE = 8 * 1024 * 1024  # The progress recorded in the sidecar: the resume point if killed
+
+    # Large files are split into byte ranges fetched in parallel.
+    SEGMENTED_THRESHOLD = 16 * 1024 * 1024
+    SEGMENT_COUNT = 4
+    MAX_CONCURRENT_SEGMENTS = 8
+
+
 EXTENSION_CANDIDATES = ('jpg', 'jpeg', 'png', 'gif', 'jfif', 'webp', 'mp4', 'webm', 'mov')
+EXTENSION_ALIASES = {'jpeg': 'jpg', 'jfif': 'jpg'}
+
+__executor = ThreadPoolExecutor(max_workers=Constants.MAX_CONCURRENT_DOWNLOADS, thread_name_prefix='downloader')
+__host_semaphores = {}  # {'cdn.domain.com': BoundedSemaphore, ...}
+__host_semaphores_lock = threading.Lock()
+__pending_futures = []  # Submitted, but not waited yet.
+__pending_futures_lock = threading.Lock()
+__parts_in_flight = set()  # The .part paths being written: the same target submitted twice is fetched once.
+__parts_in_flight_lock = threading.Lock()
+__segment_executor = ThreadPoolExecutor(max_workers=Constants.MAX_CONCURRENT_SEGMENTS, thread_name_prefix='segment')
+__hosts_without_ranges = set()  # Hosts that refused a segment: large files from them come in a single stream.
 
 
 def log(message: str, has_tst: bool = True):
@@ -13,36 +55,64 @@ def log(message: str, has_tst: bool = True):
     common.log(message, path, has_tst)
 
 
-def extract_extension(source_url: str) -> str:
-    content_type_attribute = 'content-type'
+def sniff_extension(head: bytes) -> str:
+    # Magic bytes at the head of the file
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    elif head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    elif head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    elif head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    elif head[:4] == b'\x1a\x45\xdf\xa3':  # EBML: Matroska-based, served as webm
+        return 'webm'
+    elif head[4:8] == b'ftyp':  # ISO base media: the brand tells QuickTime from mp4.
+        return 'mov' if head[8:12] == b'qt  ' else 'mp4'
+    else:
+        return ''
+
 
-    # Primary target: filetype from the html header
+def __extension_from_content_type(content_type: str, source_url: str, is_logged: bool) -> str:
     try:
-        header = requests.head(source_url).headers
-        if content_type_attribute in header:
-            header = header[content_type_attribute]
-            try:
-                category, filetype = header.split('/')
-            except ValueError:
-                filetype = header
-                category = None
-            if filetype == 'quicktime':  # 'video/quicktime' represents a mov file.
-                filetype = 'mov'
-
-            # Check the file type.
-            if filetype in EXTENSION_CANDIDATES:
-                return filetype
-            elif category == 'text':
-                log('Warning: a text page(%s)' % source_url)
-            else:
-                log('Error: unexpected %s/%s\n(Source: %s)' %
-                    (category, filetype, source_url))
-    except Exception as header_exception:
-        log('Error: cannot process the header.(%s)\n(Source: %s)' % (header_exception, source_url))
+        category, filetype = content_type.split(';')[0].strip().split('/')
+    except ValueError:
+        filetype = content_type
+        category = None
+    if filetype == 'quicktime':  # 'video/quicktime' represents a mov file.
+        filetype = 'mov'
+
+    # Check the file type.
+    if filetype in EXTENSION_CANDIDATES:
+        return filetype
+    elif not is_logged:  # The content will tell.
+        pass
+    elif category == 'text':
+        log('Warning: a text page(%s)' % source_url)
+    else:
+        log('Error: unexpected %s/%s\n(Source: %s)' %
+            (category, filetype, source_url))
+    return ''
+
+
+def extract_extension(source_url: str, content_type: str = None, head: bytes = b'') -> str:
+    # Decide the extension from a response: its header, the first bytes of its content, then the url.
+    sniffed_extension = sniff_extension(head)
+
+    # Primary target: filetype from the html header, unless the content says otherwise.
+    if content_type:
+        header_extension = __extension_from_content_type(content_type, source_url, not sniffed_extension)
+        if header_extension:
+            if not sniffed_extension or EXTENSION_ALIASES.get(header_extension, header_extension) == \
+                    EXTENSION_ALIASES.get(sniffed_extension, sniffed_extension):
+                return header_extension
+            log('Warning: %s served as %s.\n(Source: %s)' % (sniffed_extension, content_type, source_url))
+    if sniffed_extension:
+        return sniffed_extension
 
     # After all, the extension has not been retrieved.
     # Try extract the extension from the url. (e.g. https://www.domain.com/video.mp4)
-    chunk = source_url.split('.')[-1]
+    chunk = source_url.split('?')[0].split('.')[-1]
     if chunk in EXTENSION_CANDIDATES:
         return chunk
     else:
@@ -78,68 +148,372 @@ def iterate_source_tags(source_tags, file_name, url_referring_article, ignored_f
                         log('Ignoring based on file name: %s.\n(Article: %s)' % (source_url, url_referring_article))
                         break  # Skip this source tag.
                 else:  # Retrieve the extension.
-                    download_source(file_name, i, source_url)
+                    submit_source(file_name, i, source_url)
             else:
-                download_source(file_name, i, source_url)
+                submit_source(file_name, i, source_url)
 
 
 def download_source(file_name, i, source_url):
-    extension = extract_extension(source_url)
-    if extension:
-        print('%s-*.%s on %s' % (file_name, extension, source_url))
-        # Download the file.
-        download(source_url, '%s-%03d.%s' % (file_name, i, extension))
+    download_as(source_url, '%s-%03d' % (file_name, i))
+
+
+def __get_host_semaphore(source_url: str) -> threading.BoundedSemaphore:
+    host = urlparse(source_url).netloc
+    with __host_semaphores_lock:
+        if host not in __host_semaphores:
+            __host_semaphores[host] = threading.BoundedSemaphore(Constants.MAX_CONCURRENT_DOWNLOADS_PER_HOST)
+        return __host_semaphores[host]
+
+
+def __run_with_host_limit(source_url: str, task, args: ()):
+    # A worker waiting for a busy host holds its thread, but the host limit is smaller than the pool.
+    with __get_host_semaphore(source_url):
+        try:
+            task(*args)
+        except Exception as task_exception:
+            log('Error: download task failed.(%s)\n(Source: %s)\n[Traceback]\n%s' %
+                (task_exception, source_url, traceback.format_exc()))
+
+
+def submit(source_url: str, task, *args):
+    # Run task(*args) on the download pool, counting it against the host of source_url.
+    future = __executor.submit(__run_with_host_limit, source_url, task, args)
+    with __pending_futures_lock:
+        __pending_futures.append(future)
+    return future
+
+
+def submit_source(file_name, i, source_url):
+    # The index is fixed on submission, so the names are the same as downloading one by one.
+    return submit(source_url, download_source, file_name, i, source_url)
+
+
+def wait_for_downloads():
+    # Block until every submitted download has finished. (e.g. at the end of an article)
+    with __pending_futures_lock:
+        futures = list(__pending_futures)
+        __pending_futures.clear()
+    wait(futures)
 
 
 def wait_finish_downloading(temp_dir_path: str, log_path: str, loading_sec: float, trial: int = 0,
-                            is_logged: bool = True):
-    seconds = 0
-    check_interval = 1
-    timeout_multiplier = (trial + 1) ** 4 + 1  # 2, 17, 82, ...
-    max_timeout = 480
+                            is_logged: bool = True, site: str = None, expected_bytes: float = None, tracker=None):
+    # tracker: the devtools.DownloadTracker of the browser, woken by its download events instead of watching files
+    if site:  # From the throughput and latency observed on the site: stalled downloads fail fast.
+        timeout = throughput.get_timeout(site, expected_bytes) * (trial + 1)
+        stall_sec = throughput.get_stall_sec(site)
+    else:
+        timeout_multiplier = (trial + 1) ** 4 + 1  # 2, 17, 82, ...
+        max_timeout = 480
 
-    # The timeout: 10 ~ 480
-    timeout = max(10 * (trial + 1), int(loading_sec * timeout_multiplier))
-    if timeout > max_timeout:
-        timeout = max_timeout
+        # The timeout: 10 ~ 480
+        timeout = max(10 * (trial + 1), int(loading_sec * timeout_multiplier))
+        if timeout > max_timeout:
+            timeout = max_timeout
+        stall_sec = None
     if is_logged:
         common.log('Trial: %d / Timeout: %d(<-%.1f)' % (trial + 1, timeout, loading_sec), log_path, False)
 
+    # Stalls count from the first byte, and the deadline follows the bytes remaining once known.
+    clock = throughput.TransferClock(timeout, stall_sec, site, expected_bytes)
+    start_time = datetime.now()
+    if tracker:
+        is_finished = tracker.wait_for_downloads(clock)
+    else:
+        is_finished = __wait_finish_downloading(temp_dir_path, clock)
+    if is_finished and site:
+        size = sum(os.path.getsize(f) for f in glob(temp_dir_path + '*') if os.path.isfile(f))
+        throughput.observe(site, size, common.get_elapsed_sec(start_time), loading_sec, items=1)
+    return is_finished
+
+
+def __wait_finish_downloading(temp_dir_path: str, clock: throughput.TransferClock) -> bool:
+    # Return as soon as the file lands, if the platform tells.
+    if dirwatch.is_supported():
+        try:
+            return dirwatch.wait_for_completion(temp_dir_path, clock)
+        except OSError as watch_exception:  # e.g. out of inotify watches: poll instead.
+            print('Warning: cannot watch %s.(%s)' % (temp_dir_path, watch_exception))
+
+    check_interval = 1
     last_size = 0
-    while seconds <= timeout:
-        current_size = sum(os.path.getsize(f) for f in glob(temp_dir_path + '*') if os.path.isfile(f))
-        if current_size == last_size and last_size > 0:
+    while True:
+        if dirwatch.is_complete(temp_dir_path):  # A final file, and no partial one left
             return True
-        print('Waiting to finish downloading. (%d/%d)' % (seconds, timeout))
+        current_size = sum(os.path.getsize(f) for f in glob(temp_dir_path + '*') if os.path.isfile(f))
+        clock.update(current_size if current_size else None)
+        failure = clock.get_failure()
+        if failure:
+            print(failure)
+            return False
+        print('Waiting to finish downloading. (%.0f" left)' % clock.get_wait_sec())
         # Report
         if current_size != last_size:
             print('%.1f -> %.1f MB' % (last_size / 1000000, current_size / 1000000))
         # Wait
         time.sleep(check_interval)
-        seconds += check_interval
         last_size = current_size
-    print('Download timeout reached.')
-    return False  # Timeout
 
 
 def download(url: str, local_name: str):
+    local_stem, extension = common.split_on_last_pattern(local_name, '.')
+    __download_resumably(url, local_stem, extension)
+
+
+def download_as(url: str, local_stem: str):
+    # Download in a single request: the extension is decided once the first bytes arrive.
+    __download_resumably(url, local_stem)
+
+
+def __download_resumably(url: str, local_stem: str, extension: str = ''):
+    # Skip the sources fetched on the previous runs: the date windows overlap.
+    downloaded = ledger.lookup(url)
+    if downloaded:
+        print('Already downloaded as %s: %s' % (downloaded[1], url))
+        return
+
     # Set the absolute path to store the downloaded file.
     common.check_dir_exists(common.Constants.DOWNLOAD_PATH)
+    part_path = os.path.join(common.Constants.DOWNLOAD_PATH, local_stem + '.part')
+    with __parts_in_flight_lock:
+        if part_path in __parts_in_flight:
+            print('Already downloading as %s: %s' % (local_stem, url))
+            return
+        __parts_in_flight.add(part_path)
 
-    # Set the download target.
-    r = requests.get(url, stream=True)
+    try:
+        for trial in range(Constants.DOWNLOAD_RETRIES):
+            try:
+                local_name = __fetch_part(url, part_path, extension)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as interruption:
+                log('Warning: Download interrupted.(trial %d)(%s)\n(Source: %s)' %
+                    (trial + 1, interruption, url), False)
+        else:  # The .part file is left to be resumed on the next run.
+            log("Error: Download failed.(%s)" % url, False)
+            return
+    finally:
+        with __parts_in_flight_lock:
+            __parts_in_flight.discard(part_path)
 
+    if not local_name:  # Nothing to store, or stored by the converter
+        return
     file_path = os.path.join(common.Constants.DOWNLOAD_PATH, local_name)
-    if r.ok:
-        with open(file_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024 * 8):
+    if local_name.endswith('webp'):  # Convert off the download path.
+        png_path = common.split_on_last_pattern(file_path, '.')[0] + '.png'
+        converter.submit_file(file_path, png_path + '.part',
+                              lambda: __store_converted(url, png_path + '.part', png_path))
+    else:
+        __register(url, file_path)
+
+
+def __store_converted(url: str, temp_path: str, file_path: str, part_path: str = None):
+    blobstore.commit(temp_path, file_path)
+    print('file://%s' % file_path)
+    __register(url, file_path)
+    if part_path:  # Converted from the downloaded bytes: nothing to resume anymore.
+        os.remove(part_path + '.json')
+
+
+def __keep_part(part_path: str, data: bytes):
+    # The next run finds the .part file complete, and converts it from there.
+    with filesink.FileSink(part_path) as sink:
+        sink.write(data)
+    log('Warning: conversion failed, kept for the next run.(%s)' % part_path, False)
+
+
+def __register(url: str, file_path: str):
+    if perceptual.screen(file_path):
+        ledger.record(url, os.path.getsize(file_path), file_path)
+    else:  # Removed as a near-duplicate: do not try again either.
+        ledger.record(url, 0, '')
+
+
+def __read_part_meta(part_path: str) -> dict:
+    try:
+        with open(part_path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def __write_part_meta(part_path: str, meta: dict):
+    with open(part_path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def __fetch_part(url: str, part_path: str, extension: str) -> str:
+    # Write to the .part file, resuming from its last byte if the sidecar matches. Return the local name.
+    meta = __read_part_meta(part_path)
+    is_resumable = meta.get('url') == url and os.path.exists(part_path)
+    if is_resumable and meta.get('segments') and urlparse(url).netloc not in __hosts_without_ranges:
+        print('Resuming %d segments: %s' % (len([s for s in meta['segments'] if not s[2]]), url))
+        __fetch_segments(url, part_path, meta)
+        return __commit_part(part_path, meta)
+    # The file may be preallocated: only the bytes recorded as received count.
+    offset = 0
+    if is_resumable and not meta.get('segments'):
+        offset = min(meta.get('received', 0), os.path.getsize(part_path))
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes=%d-' % offset
+        if meta['validator']:  # Send the whole file instead if it has changed.
+            headers['If-Range'] = meta['validator']
+
+    # Closing the response returns the connection to the pool.
+    with common.get_session().get(url, stream=True, headers=headers, timeout=Constants.DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 416 and offset:
+            if offset == meta['length']:  # Complete, but not renamed.
+                return __commit_part(part_path, meta)
+            os.remove(part_path)  # Not a prefix of the file anymore: start over on the next trial.
+            raise requests.exceptions.ConnectionError('The range of %d bytes is not satisfiable' % offset)
+        if not r.ok:  # HTTP status code 4XX/5XX
+            log("Error: Download failed.(HTTP %d)(%s)" % (r.status_code, url), False)
+            return ''
+
+        chunks = r.iter_content(chunk_size=Constants.CHUNK_SIZE)
+        content_range = r.headers.get('content-range', '')  # bytes 1000-1999/2000
+        if r.status_code == 206 and content_range.startswith('bytes %d-' % offset):
+            print('Resuming from %.1f MB: %s' % (offset / 1000000, url))
+            is_new = False
+        else:  # A fresh start
+            offset = 0
+            is_new = True
+            first_chunk = next(chunks, b'')
+            extension = extension or extract_extension(url, r.headers.get('content-type'), first_chunk)
+            if not extension:
+                return ''
+            print('%s.%s on %s' % (os.path.basename(part_path)[:-len('.part')], extension, url))
+            etag = r.headers.get('etag', '')
+            length = r.headers.get('content-length')
+            meta = {'url': url,
+                    'received': 0,
+                    'validator': etag if etag and not etag.startswith('W/') else r.headers.get('last-modified'),
+                    # The length on the wire differs from the written one if encoded.
+                    'length': int(length) if length and 'content-encoding' not in r.headers else None,
+                    'extension': extension}
+            chunks = itertools.chain((first_chunk,), chunks)
+            if extension == 'webp' and meta['length'] and meta['length'] <= converter.Constants.IN_MEMORY_LIMIT:
+                # Convert the downloaded bytes: no file to write, read back and delete.
+                data = b''.join(chunks)
+                if len(data) != meta['length']:
+                    raise requests.exceptions.ChunkedEncodingError('%d/%d bytes received' % (len(data), meta['length']))
+                # Recorded first: if the conversion fails, the bytes are kept as a complete .part file.
+                meta['received'] = len(data)
+                __write_part_meta(part_path, meta)
+                png_path = part_path[:-len('.part')] + '.png'
+                converter.submit_bytes(data, png_path + '.part',
+                                       lambda: __store_converted(url, png_path + '.part', png_path, part_path),
+                                       lambda: __keep_part(part_path, data))
+                return ''
+            if meta['length'] and meta['length'] >= Constants.SEGMENTED_THRESHOLD and \
+                    r.headers.get('accept-ranges') == 'bytes' and urlparse(url).netloc not in __hosts_without_ranges:
+                # A large file: this stream serves the first segment, and the others come in parallel.
+                meta['segments'] = __split_into_segments(meta['length'])
+                __write_part_meta(part_path, meta)
+                __fetch_segments(url, part_path, meta, chunks)
+                return __commit_part(part_path, meta)
+            __write_part_meta(part_path, meta)
+
+        sink = filesink.FileSink(part_path, offset, meta['length'], is_new, is_hashed=True)
+        try:
+            next_checkpoint = offset + Constants.CHECKPOINT_SIZE
+            for chunk in chunks:
                 if chunk:
-                    f.write(chunk)
-                    f.flush()
-                    os.fsync(f.fileno())
-        print('file://%s' % file_path)
-    else:  # HTTP status code 4XX/5XX
-        log("Error: Download failed.(%s)" % url, False)
-
-    if local_name.endswith('webp'):
-        common.convert_webp_to_png(common.Constants.DOWNLOAD_PATH, local_name)
+                    sink.write(chunk)
+                    if sink.position >= next_checkpoint:  # The data first: the sidecar never runs ahead of it.
+                        meta['received'] = sink.flush()
+                        __write_part_meta(part_path, meta)
+                        next_checkpoint = sink.position + Constants.CHECKPOINT_SIZE
+        finally:  # Record the progress to resume from.
+            meta['received'] = sink.close()
+            __write_part_meta(part_path, meta)
+
+    if meta['length'] and meta['received'] != meta['length']:  # The server closed the connection early.
+        raise requests.exceptions.ChunkedEncodingError('%d/%d bytes received' % (meta['received'], meta['length']))
+    return __commit_part(part_path, meta, sink.digest())
+
+
+def __split_into_segments(length: int) -> []:
+    segment_size = -(-length // Constants.SEGMENT_COUNT)  # Round up.
+    # [[first byte, last byte, done], ...]
+    return [[start, min(start + segment_size, length) - 1, False] for start in range(0, length, segment_size)]
+
+
+def __fetch_segments(url: str, part_path: str, meta: dict, head_chunks=None):
+    # Fetch the remaining segments into the preallocated .part file. The first one may come from an open stream.
+    # Each connection counts against the host: this job holds one slot, and the free ones are taken without waiting,
+    # so that jobs holding their slots never wait for each other.
+    meta_lock = threading.Lock()
+    if head_chunks is not None:
+        filesink.FileSink(part_path, length=meta['length']).close()  # Preallocate.
+    pending = [segment for n, segment in enumerate(meta['segments'])
+               if not segment[2] and not (n == 0 and head_chunks is not None)]
+    host_semaphore = __get_host_semaphore(url)
+    slots = 0
+    while slots < len(pending) and host_semaphore.acquire(blocking=False):
+        slots += 1
+    lanes = [pending[n::slots + 1] for n in range(slots + 1)]  # The last one in this thread, on the slot of the job
+    futures = [__segment_executor.submit(__fetch_lane, url, part_path, meta, lane, meta_lock) for lane in lanes[:-1]]
+    try:
+        if head_chunks is not None:
+            __fetch_segment(url, part_path, meta, meta['segments'][0], meta_lock, head_chunks)
+        __fetch_lane(url, part_path, meta, lanes[-1], meta_lock)
+    finally:  # Let the others finish, so that a retry does not write the same segments at the same time.
+        wait(futures)
+        for _ in range(slots):
+            host_semaphore.release()
+    for future in futures:
+        future.result()  # Raise the first failure, if any.
+
+
+def __fetch_lane(url: str, part_path: str, meta: dict, segments: [], meta_lock: threading.Lock):
+    # The segments one after another, over a single connection slot
+    for segment in segments:
+        __fetch_segment(url, part_path, meta, segment, meta_lock)
+
+
+def __fetch_segment(url: str, part_path: str, meta: dict, segment: [], meta_lock: threading.Lock, chunks=None):
+    start, end = segment[0], segment[1]
+    if chunks is None:
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        if meta['validator']:
+            headers['If-Range'] = meta['validator']
+        with common.get_session().get(url, stream=True, headers=headers, timeout=Constants.DOWNLOAD_TIMEOUT) as r:
+            if r.status_code != 206 or not r.headers.get('content-range', '').startswith('bytes %d-' % start):
+                # Ranges refused, or the file has changed: the next trial starts over with a single stream.
+                __hosts_without_ranges.add(urlparse(url).netloc)
+                raise requests.exceptions.ConnectionError('Range %d-%d refused(HTTP %d)' % (start, end, r.status_code))
+            written = __write_segment(part_path, start, end, r.iter_content(chunk_size=Constants.CHUNK_SIZE))
+    else:
+        written = __write_segment(part_path, start, end, chunks)
+
+    if written != end - start + 1:
+        raise requests.exceptions.ChunkedEncodingError('Segment %d-%d: %d bytes received' % (start, end, written))
+    with meta_lock:
+        segment[2] = True
+        __write_part_meta(part_path, meta)
+
+
+def __write_segment(part_path: str, start: int, end: int, chunks) -> int:
+    remaining = end - start + 1
+    with filesink.FileSink(part_path, start, is_new=False) as sink:
+        for chunk in chunks:
+            if chunk:
+                chunk = chunk[:remaining]
+                sink.write(chunk)
+                remaining -= len(chunk)
+                if remaining == 0:
+                    break
+    return end - start + 1 - remaining
+
+
+def __commit_part(part_path: str, meta: dict, digest: str = None) -> str:
+    # Move the complete file into place, sharing the bytes with an identical file if any, and drop the sidecar.
+    local_name = '%s.%s' % (os.path.basename(part_path)[:-len('.part')], meta['extension'])
+    file_path = os.path.join(common.Constants.DOWNLOAD_PATH, local_name)
+    blobstore.commit(part_path, file_path, digest)
+    os.remove(part_path + '.json')
+    print('file://%s' % file_path)
+    return local_name
@@ -0,0 +1,102 @@
+import hashlib
+import os
+
+
+class Constants:
+    # 'none': never fsync, 'on-close': fsync once when closing, 'paranoid': fsync every write
+    DURABILITY_MODES = ('none', 'on-close', 'paranoid')
+    DURABILITY = 'on-close'
+    BUFFER_SIZE = 1024 * 1024
+    HASH_NAME = 'sha256'
+
+
+class FileSink:
+    # A buffered writer to a temporary file, moved into place by commit().
+    def __init__(self, path: str, offset: int = 0, length: int = None, is_new: bool = True, durability: str = None,
+                 is_hashed: bool = False):
+        self.path = path
+        self.durability = durability if durability else Constants.DURABILITY
+        if self.durability not in Constants.DURABILITY_MODES:
+            raise ValueError('Unknown durability mode: %s' % self.durability)
+
+        if is_new:  # Create the file, reserving the blocks if the length is known.
+            self.file = open(path, 'wb', buffering=Constants.BUFFER_SIZE)
+            if length:
+                self.__preallocate(length)
+        else:  # Write into an existing file. (e.g. resuming, or a segment of a preallocated file)
+            self.file = open(path, 'r+b', buffering=Constants.BUFFER_SIZE)
+            self.file.seek(offset)
+        self.position = offset
+
+        # Hash the content while streaming. Resuming, the bytes already written are read once.
+        self.hasher = None
+        if is_hashed:
+            self.hasher = hashlib.new(Constants.HASH_NAME)
+            if offset:
+                with open(path, 'rb') as f:
+                    remaining = offset
+                    while remaining > 0:
+                        data = f.read(min(remaining, Constants.BUFFER_SIZE))
+                        if not data:
+                            break
+                        self.hasher.update(data)
+                        remaining -= len(data)
+
+    def __preallocate(self, length: int):
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, length)
+        except (AttributeError, OSError):  # Not supported by the platform or the file system
+            self.file.truncate(length)
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.position += len(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.durability == 'paranoid':
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def flush(self) -> int:
+        # Hand the data to the file system, persisted unless the durability is 'none'. Return the position.
+        self.file.flush()
+        if self.durability != 'none':
+            os.fsync(self.file.fileno())
+        return self.position
+
+    def close(self) -> int:
+        # Return the position, up to which the data has been handed to the file system.
+        if not self.file.closed:
+            self.file.flush()
+            if self.durability != 'none':
+                os.fsync(self.file.fileno())
+            self.file.close()
+        return self.position
+
+    def digest(self) -> str:
+        return self.hasher.hexdigest() if self.hasher is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def hash_file(path: str) -> str:
+    hasher = hashlib.new(Constants.HASH_NAME)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(Constants.BUFFER_SIZE), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def commit(temp_path: str, final_path: str, durability: str = None):
+    # Atomically move a complete file into place: readers never see a partial file under the final name.
+    os.replace(temp_path, final_path)
+    if (durability if durability else Constants.DURABILITY) != 'none':  # Persist the rename as well.
+        dir_fd = os.open(os.path.dirname(final_path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
@@ -9,8 +9,12 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 from bs4 import BeautifulSoup
 
+import blobstore
+import browserpool
 import common
+import converter
 import downloader
+import sessioncache
 
 
 class Constants:
@@ -31,6 +35,45 @@ class Constants:
     HTML_PARSER = 'html.parser'
     EXTENSION_CANDIDATES = ('jpg', 'jpeg', 'png', 'gif', 'jfif', 'mp4', 'webp', 'webm')
     VIDEO_SOURCE_CANDIDATES = ('gfycat', 'redgifs')
+    SITE = 'gg'
+    IS_FETCHING_PAGES_OVER_HTTP = True  # With the cookies of the browser, which is used only behind the auth wall
+    AUTH_WALL_SELECTOR = 'div.login-header'
+    # The browser only reads the DOM: the sources are downloaded without it.
+    BLOCKED_URL_PATTERNS = common.Constants.BLOCKED_URL_PATTERNS + common.Constants.BLOCKED_MEDIA_PATTERNS
+    IS_LOADING_IMAGES = False
+
+    # Run in the browser: only the fields read are sent back, instead of the whole page source.
+    ROW_SELECTOR = 'table.bd_lst > tbody > tr'
+    ROW_EXTRACTION_SCRIPT = '''
+        return Array.from(document.querySelectorAll(arguments[0])).map(function (row) {
+            var time = row.querySelector('td.time'), likes = row.querySelector('td.m_no > span');
+            var cate = row.querySelector('td.cate'), link = row.querySelector('td.title > a.hx');
+            return {time: time ? time.getAttribute('title') : null, date: time ? time.textContent : null,
+                    likes: likes ? likes.textContent : null, cate: cate ? cate.textContent : null,
+                    title: link ? link.textContent : null, href: link ? link.getAttribute('href') : null};
+        });'''
+    # Resolves once no embed has been added or changed for EMBED_QUIET_MS, at once if the loaded page has none.
+    EMBED_SELECTOR = 'iframe, video, .gfycatWrap'
+    EMBED_QUIET_MS = 1500
+    EMBED_SETTLING_SCRIPT = '''
+        var selector = arguments[0], quietMs = arguments[1], timeoutMs = arguments[2];
+        var callback = arguments[arguments.length - 1];
+        var root = document.querySelector('div#article_1') || document.body;
+        if (document.readyState === 'complete' && root.querySelectorAll(selector).length === 0) {
+            callback(0);
+            return;
+        }
+        var start = Date.now(), lastChange = Date.now();
+        var observer = new MutationObserver(function () { lastChange = Date.now(); });
+        observer.observe(root, {childList: true, subtree: true, attributes: true});
+        var timer = setInterval(function () {
+            var now = Date.now();
+            if ((document.readyState === 'complete' && now - lastChange >= quietMs) || now - start >= timeoutMs) {
+                clearInterval(timer);
+                observer.disconnect();
+                callback(root.querySelectorAll(selector).length);
+            }
+        }, 100);'''
     LOG_PATH = common.read_from_file('GG_LOG_PATH.pv')
 
 
@@ -43,9 +86,13 @@ def initiate_browser():
     # A Chrome web driver with headless option
     # service = Service(common.Constants.DRIVER_PATH)
     options = webdriver.ChromeOptions()
+    if not Constants.IS_LOADING_IMAGES:
+        options.add_experimental_option("prefs", common.Constants.IMAGE_BLOCKING_PREFS)
     options.add_argument('headless')
     # options.add_argument('disable-gpu')
     driver = webdriver.Chrome(executable_path=common.Constants.DRIVER_PATH, options=options)
+    common.block_urls(driver, Constants.BLOCKED_URL_PATTERNS)
+    sessioncache.restore_to_driver(Constants.SITE, driver)  # Logged in already, unless rejected
     return driver
 
 
@@ -59,27 +106,97 @@ def __get_date_difference(tst_str: str) -> int:
     return (now - date).days
 
 
+def __get_page_session():
+    global page_session
+    if page_session is None:
+        page_session = common.build_session_from_driver(browser)
+    return page_session
+
+
+def fetch_page(url: str):
+    # Return the soup of the page fetched without the browser, None if the browser is required.
+    if not Constants.IS_FETCHING_PAGES_OVER_HTTP:
+        return None
+    try:
+        response = __get_page_session().get(url, timeout=common.Constants.HTTP_PAGE_TIMEOUT)
+        if response.status_code != 200:
+            print('Warning: HTTP response %d. Loading %s with the browser.' % (response.status_code, url))
+            return None
+        soup = BeautifulSoup(response.text, Constants.HTML_PARSER)
+        if soup.select_one(Constants.AUTH_WALL_SELECTOR):
+            print('Login required: loading %s with the browser.' % url)
+            global is_authenticated
+            is_authenticated = False
+            return None
+        return soup
+    except Exception as http_exception:
+        print('Warning: cannot fetch %s.(%s)' % (url, http_exception))
+        return None
+
+
+def load_page_in_browser(url: str):
+    # Return the soup of the page rendered by the browser, logging in if required. None if not accessible.
+    for trial in range(2):
+        is_auth = check_auth(browser, url)
+        if is_auth:
+            break  # No (further) authentication required. Good to go.
+    else:
+        return None
+
+    common.copy_driver_cookies(browser, __get_page_session())  # Logged in for the next fetches.
+    return BeautifulSoup(browser.page_source, Constants.HTML_PARSER)
+
+
+def wait_for_embeds(timeout: int) -> int:
+    # Return the number of the embeds of the loaded article once they have settled.
+    browser.set_script_timeout(timeout + 5)
+    return browser.execute_async_script(Constants.EMBED_SETTLING_SCRIPT, Constants.EMBED_SELECTOR,
+                                        Constants.EMBED_QUIET_MS, timeout * 1000)
+
+
+def __extract_rows(soup: BeautifulSoup) -> []:
+    # The same fields as ROW_EXTRACTION_SCRIPT, from a page fetched without the browser
+    rows = []
+    for row in soup.select(Constants.ROW_SELECTOR):
+        time_tag = row.select_one('td.time')
+        likes_tag = row.select_one('td.m_no > span')
+        cate_tag = row.select_one('td.cate')
+        link_tag = row.select_one('td.title > a.hx')
+        rows.append({'time': time_tag.get('title') if time_tag else None,
+                     'date': time_tag.get_text() if time_tag else None,
+                     'likes': likes_tag.get_text() if likes_tag else None,
+                     'cate': cate_tag.get_text() if cate_tag else None,
+                     'title': link_tag.get_text() if link_tag else None,
+                     'href': link_tag.get('href') if link_tag else None})
+    return rows
+
+
 def get_entries_to_scan(placeholder: str, extensions: (), min_likes: int, scanning_span: int, page: int = 1) -> ():
     max_page = page + scanning_span - 1  # To prevent infinite looping
     log('Scanning pages on %s' % placeholder + str(page))
-    tst_attribute = 'title'
     to_scan = []
 
     while page <= max_page:  # Page-wise
         start_time = datetime.now()  # A timer for monitoring performance
         url = placeholder + str(page)
-        browser.get(url)
-        rows = BeautifulSoup(browser.page_source, Constants.HTML_PARSER).select('table.bd_lst > tbody > tr')
+        soup = fetch_page(url)
+        if soup is not None:
+            rows = __extract_rows(soup)
+        else:
+            if not check_auth(browser, url):
+                log('Error: Authentication required accessing %s.' % url)
+                return tuple(to_scan)
+            common.copy_driver_cookies(browser, __get_page_session())  # Logged in for the next fetches.
+            rows = browser.execute_script(Constants.ROW_EXTRACTION_SCRIPT, Constants.ROW_SELECTOR)
 
         for i, row in enumerate(rows):  # Inspect the rows
-            tst_tag = row.select_one('td.time')
-            if not tst_tag or not tst_tag.has_attr(tst_attribute):  # Non-regular rows, e.g. notices
+            if not row['time']:  # Non-regular rows, e.g. notices
                 continue
             else:  # Not a notice, a regular row. Determine if worth scanning.
-                if ':' not in tst_tag[tst_attribute]:  # Not mature: less than 24 hours.
+                if ':' not in row['time']:  # Not mature: less than 24 hours.
                     continue  # Move to the next row
                 else:
-                    row_date = tst_tag.string
+                    row_date = row['date'].strip()
                     day_diff = __get_date_difference(row_date)
                     if day_diff <= Constants.TOO_YOUNG_DATE:  # Still, not mature: uploaded on the yesterday.
                         log('#%02d\t\t| Skipping the too young.' % (i + 1))
@@ -92,18 +209,17 @@ def get_entries_to_scan(placeholder: str, extensions: (), min_likes: int, scanni
                         return tuple(to_scan)
 
             # Based on the uploaded time, worth scanning.
-            likes_tag = row.select_one('td.m_no > span')
-            likes = int(likes_tag.string) if likes_tag else 0
+            likes = __parse_likes(row['likes'])
             if likes >= min_likes:  # Compare likes first: a cheaper process
-                cate = row.select_one('td.cate').string
+                cate = row['cate'].strip()
                 if cate in extensions:  # Compare cate then: a more expensive process
-                    title = row.select_one('td.title > a.hx').string.strip()
+                    title = row['title'].strip()
                     for pattern in common.Constants.IGNORED_TITLE_PATTERNS:  # The most expensive comparison
                         if pattern in title:
                             log('#%02d (%s) %s \t| (ignored) %s' % (i + 1, likes, cate, title))
                             break
                     else:
-                        to_scan.append(row.select_one('td.title > a.hx')['href'].split('srl=')[-1])
+                        to_scan.append(row['href'].split('srl=')[-1])
                         log('#%02d (%s) %s \t| %s' % (i + 1, likes, cate, title))
 
         log('Page %d took %.1f".' % (page, common.get_elapsed_sec(start_time)))
@@ -113,16 +229,12 @@ def get_entries_to_scan(placeholder: str, extensions: (), min_likes: int, scanni
 
 
 def scan_article(url: str):
-    for trial in range(2):
-        is_auth = check_auth(browser, url)
-        if is_auth:
-            break  # No (further) authentication required. Good to go.
-    else:
-        return
-
-    if browser.current_url != url:
-        browser.get(url)
-    soup = BeautifulSoup(browser.page_source, Constants.HTML_PARSER)
+    soup = fetch_page(url)
+    is_rendered = soup is None
+    if is_rendered:
+        soup = load_page_in_browser(url)
+        if soup is None:
+            return
 
     # Retrieve the title.
     article_title_tag = soup.select_one('div.main > div.content div.top_area > h1')
@@ -172,14 +284,18 @@ def scan_article(url: str):
         video_wrapper_timeout = 30
         video_filename_tag = '-v'
         is_video_expected = cate == 'avi'
+        if not is_rendered and not soup.select('iframe, video'):  # The players may be inserted by scripts.
+            soup = load_page_in_browser(url) or soup
+            is_rendered = True
+        found_video_source = False
         try:
-            WebDriverWait(browser, video_wrapper_timeout).until(
-                expected_conditions.visibility_of_all_elements_located((By.CLASS_NAME, 'gfycatWrap')))
-            video_source_tags = soup.select('iframe')
-            if video_source_tags:
-                found_video_source = iterate_video_source_tags(video_source_tags, local_name + video_filename_tag)
-                if is_video_expected and not found_video_source:
-                    log('Error: <video> tag present, but no source found.', False)
+            if is_rendered and wait_for_embeds(video_wrapper_timeout) > 0:
+                soup = BeautifulSoup(browser.page_source, Constants.HTML_PARSER)  # With the embeds inserted
+                video_source_tags = soup.select('iframe')
+                if video_source_tags:
+                    found_video_source = iterate_video_source_tags(video_source_tags, local_name + video_filename_tag)
+                    if is_video_expected and not found_video_source:
+                        log('Error: <video> tag present, but no source found.', False)
         except selenium.common.exceptions.TimeoutException:
             pass
         except selenium.common.exceptions.NoSuchElementException:
@@ -188,7 +304,9 @@ def scan_article(url: str):
             log('Error: %s\n[Traceback]\n%s' % (video_source_err, traceback.format_exc()))
 
         # Usual gfycatWrap not present: check unusual sources present.
-        if soup.select('video'):
+        if found_video_source:  # Already submitted from the rendered page
+            pass
+        elif soup.select('video'):
             video_source_tags = soup.select('video')
             found_video_source = iterate_video_source_tags(video_source_tags, local_name + video_filename_tag)
             if is_video_expected and not found_video_source:
@@ -209,14 +327,21 @@ def scan_article(url: str):
         else:
             if is_video_expected:
                 log('Video player not found.')
+    downloader.wait_for_downloads()
     log('Finished scanning article in %.1f".\n' % common.get_elapsed_sec(article_start_time), False)
 
 
+def __parse_likes(likes: str) -> int:
+    # The cell may be missing or blank.
+    likes = likes.strip() if likes else ''
+    return int(likes) if likes else 0
+
+
 def __get_local_name(article_title: str, url: str, likes: str):
     article_id = url.split('/')[-1]
     channel_id = url.split('/')[-2]
     domain_tag = 'gg'
-    formatted_likes = '%03d' % int(likes)
+    formatted_likes = '%03d' % __parse_likes(likes)
 
     formatted_title = article_title.strip()
     for prohibited_char in common.Constants.PROHIBITED_CHARS:
@@ -239,8 +364,7 @@ def iterate_img_source_tags(source_tags, file_name) -> bool:
                     break  # Skip the tag.
             else:
                 # Download the file.
-                extension = downloader.extract_extension(source_url)
-                downloader.download(source_url, '%s-%02d.%s' % (file_name, i, extension))
+                downloader.submit(source_url, downloader.download_as, source_url, '%s-%02d' % (file_name, i))
     return has_source
 
 
@@ -282,23 +406,35 @@ def iterate_video_source_tags(source_tags, file_name) -> bool:
                         break  # Skip the tag.
                 else:
                     # Download the file.
-                    downloader.download(source_url, '%s-%02d.%s' % (file_name, i, extension))
+                    downloader.submit(source_url, downloader.download,
+                                      source_url, '%s-%02d.%s' % (file_name, i, extension))
     return has_source
 
 
 def check_auth(driver: webdriver.Chrome, url: str):
+    # Load the page unless it is the current one, then log in only if the wall is there.
+    global is_authenticated
     timeout = 60
-    driver.get(url)
-    soup = BeautifulSoup(driver.page_source, common.Constants.HTML_PARSER)
-    if soup.select_one('div.login-header'):  # Login required
-        print('Warning: Login required accessing %s.' % url)
+    if driver.current_url != url:
+        driver.get(url)  # Returns when loaded: the wall, if any, is in the DOM already.
+    if not driver.find_elements(By.CSS_SELECTOR, Constants.AUTH_WALL_SELECTOR):
+        is_authenticated = True
+        return True  # Page body loaded
+
+    print('Warning: Login required accessing %s.' % url)
+    is_authenticated = False
+    sessioncache.invalidate(Constants.SITE)  # The cached session, if any, has been rejected.
+    driver_wait = WebDriverWait(driver, timeout)
+    try:
         driver.find_element(By.ID, 'L_user_id').send_keys(Constants.ACCOUNT)
         driver.find_element(By.ID, 'L_password').send_keys(Constants.PASSWORD)
         driver.find_element(By.XPATH, '/html/body/div[1]/div[3]/div/form/span[4]').click()
-    driver_wait = WebDriverWait(driver, timeout)
-    try:
         driver_wait.until(expected_conditions.visibility_of_element_located((By.CLASS_NAME, 'bd_lst_wrp')))
         print('Login successful.')
+        sessioncache.save(Constants.SITE, driver)
+        is_authenticated = True
+        if driver.current_url != url:  # Redirected by the form
+            driver.get(url)
         return True  # Page body visible
     except selenium.common.exceptions.TimeoutException:
         return False
@@ -313,6 +449,8 @@ def process_subdirectories(subdirectories: ()):
     for board_name, board_min_likes, extension_str in subdirectories:
         board = Constants.PAGE_PLACEHOLDER.replace('%s', board_name.strip('/'))
         for trial in range(2):
+            if is_authenticated:
+                break  # Already in this session: the pages tell if it expires.
             is_auth = check_auth(browser, board)
             if is_auth:
                 break  # No (further) authentication required. Good to go.
@@ -332,11 +470,17 @@ def process_subdirectories(subdirectories: ()):
 
 
 if __name__ == "__main__":
-    browser = initiate_browser()
+    browser_pool = browserpool.BrowserPool(initiate_browser)  # Cookies kept: stay logged in.
+    browser = browser_pool.acquire()
+    page_session = None  # Built from the browser on the first use
+    is_authenticated = False  # Of the browser session, confirmed by check_auth()
     try:
         process_subdirectories(Constants.SUBDIRECTORIES)
     except Exception as e:
         log('[Error] %s\n[Traceback]\n%s' % (e, traceback.format_exc()))
     finally:
-        browser.quit()
+        browser_pool.release(browser)
+        browser_pool.close()
+        converter.wait_for_conversions()
+        blobstore.collect_garbage_if_due()
         log("Script finished.")
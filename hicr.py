@@ -1,16 +1,25 @@
 import os
+import shutil
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import selenium.common.exceptions
 from selenium import webdriver
 # from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
-import random
 import time
 import traceback
 from datetime import datetime
-from bs4 import BeautifulSoup
+import blobstore
+import browserpool
 import common
+import converter
+import devtools
+import filesink
+import ingest
+import throughput
+import torpool
 import downloader
 
 
@@ -19,6 +28,35 @@ class Constants:
     TOO_OLD_DAY = 3
     SCANNING_SPAN = 2
     STARTING_PAGE = 1
+    SITE = 'hi'
+    # Blocked by the browser: on listing pages, and on galleries, whose download script fetches the images itself
+    BLOCKED_URL_PATTERNS = common.Constants.BLOCKED_URL_PATTERNS + common.Constants.BLOCKED_MEDIA_PATTERNS
+    DOWNLOAD_PAGE_BLOCKED_URL_PATTERNS = common.Constants.BLOCKED_URL_PATTERNS
+    IS_LOADING_IMAGES = False  # Not rendering the thumbnails saves most of the traffic through Tor.
+
+    # Run in the browser: only the fields read are sent back, instead of the whole page source.
+    ROW_EXTRACTION_SCRIPT = '''
+        return Array.from(document.querySelectorAll('div.container > div.gallery-content > div')).map(function (row) {
+            var date = row.querySelector('div > div > p.date'), link = row.querySelector('h1 > a');
+            return {date: date ? date.textContent : null, title: link ? link.textContent : null,
+                    href: link ? link.getAttribute('href') : null};
+        });'''
+    PROGRESS_BAR_ID = 'progressbar'
+    THUMBNAIL_COUNT_SCRIPT = "return document.querySelectorAll('ul.thumbnail-list > li').length;"
+
+    # Fetch the images directly through Tor, instead of the zip built by the download script in the browser.
+    IS_FETCHING_DIRECTLY = True
+    MAX_CONCURRENT_FETCHES_PER_CIRCUIT = 2  # The images of a gallery are spread over the circuits of the Tor pool.
+    FETCH_ROUNDS = 2  # The failed images only are fetched again, through the next circuits.
+    # The manifest the thumbnails are built from, with the urls resolved by the url builder of the site itself
+    GALLERY_MANIFEST_SCRIPT = '''
+        if (typeof galleryinfo === 'undefined' || typeof url_from_url_from_hash !== 'function') {
+            return null;
+        }
+        return {title: galleryinfo.title, files: galleryinfo.files.map(function (image) {
+            return {name: image.name, url: image.haswebp ? url_from_url_from_hash(galleryinfo.id, image, 'webp')
+                                                         : url_from_url_from_hash(galleryinfo.id, image)};
+        })};'''
 
     ROOT_DOMAIN = common.read_from_file('HI_ROOT.pv')
     SUBDIRECTORIES = common.build_tuple_of_tuples('HI_SUBDIRECTORIES.pv')
@@ -55,11 +93,14 @@ def initiate_browser():
     # A Chrome web driver with headless option
     # service = Service(common.Constants.DRIVER_PATH)
     options = webdriver.ChromeOptions()
-    options.add_experimental_option("prefs", {
+    prefs = {
         "download.default_directory": Constants.TMP_DOWNLOAD_PATH,
         "download.prompt_for_download": False
-    })
-    options.add_argument('--proxy-server=socks5://127.0.0.1:9050')
+    }
+    if not Constants.IS_LOADING_IMAGES:
+        prefs.update(common.Constants.IMAGE_BLOCKING_PREFS)
+    options.add_experimental_option("prefs", prefs)
+    options.add_argument('--proxy-server=%s' % torpool.get_pool().get_browser_circuit().get_browser_proxy())
     options.add_argument('headless')
     # options.add_argument('disable-gpu')
     driver = webdriver.Chrome(executable_path=common.Constants.DRIVER_PATH, options=options)
@@ -100,141 +141,235 @@ def try_access_page(driver: webdriver.Chrome, url: str, trial: int = 2):
 def scan_article(url: str, tag_name: str = None):
     min_thumbnail_count = 1
 
-    # Start a new session because clicking Download button companies irritating pop-ups
-    article_browser = initiate_browser()
+    # A warm browser from the pool: the irritating pop-ups of the Download button are closed when released.
+    article_browser = browser_pool.acquire()
     log('Processing %s' % url)
 
-    # A temporary folder to store the zip file.
-    common.check_dir_exists(Constants.TMP_DOWNLOAD_PATH)
+    # A temporary folder to store the zip file, of the gallery only.
+    download_path = Constants.TMP_DOWNLOAD_PATH + __get_gallery_id(url) + '/'
 
     # Load the article.
     page_load_start_time = datetime.now()
     try:
+        tracker = devtools.get_tracker(article_browser)
+        if tracker:  # With the download events
+            tracker.set_download_path(download_path)
+        else:
+            common.set_download_directory(article_browser, download_path)
+        common.block_urls(article_browser, Constants.DOWNLOAD_PAGE_BLOCKED_URL_PATTERNS)
         is_on_page = try_access_page(article_browser, url)
         if not is_on_page:
-            article_browser.quit()
+            browser_pool.release(article_browser, is_broken=True)
             return False
         loading_sec = common.get_elapsed_sec(page_load_start_time)
 
         # Exclude short ones.
-        soup = BeautifulSoup(article_browser.page_source, common.Constants.HTML_PARSER)
-        thumbnail_count = len(soup.select('ul.thumbnail-list > li'))
+        thumbnail_count = article_browser.execute_script(Constants.THUMBNAIL_COUNT_SCRIPT)
         if thumbnail_count < min_thumbnail_count:
             log('Too short(%d images), skipping.' % thumbnail_count)
+            browser_pool.release(article_browser)
             return True
 
+        # Fetch the images directly. The download button only if it fails.
+        if Constants.IS_FETCHING_DIRECTLY:
+            gallery = article_browser.execute_script(Constants.GALLERY_MANIFEST_SCRIPT)
+            if gallery and gallery['files']:
+                fetch_start_time = datetime.now()
+                if fetch_gallery(gallery, url, tag_name):
+                    log('Download finished.(Page loading: %.0f" / Fetching: %.1f\')' %
+                        (loading_sec, common.get_elapsed_sec(fetch_start_time) / 60))
+                    browser_pool.release(article_browser)
+                    common.remove_dir_if_empty(download_path)
+                    return True
+            log('Warning: Cannot fetch the images directly. Try the download button.')
+
         # Click the download button to start download script.
         download_start_time = datetime.now()
-        download_successful = click_download_button(article_browser, loading_sec)
+        download_successful = click_download_button(article_browser, download_path, loading_sec, thumbnail_count)
         downloading_sec = common.get_elapsed_sec(download_start_time)
 
         time_report = 'Page loading: %.0f" / Downloading: %.1f\'' % (loading_sec, (downloading_sec / 60))
-        article_browser.quit()
+        browser_pool.release(article_browser)
     except Exception as scan_article_exception:
         log('Warning: Cannot process the article.(%s)' % scan_article_exception)
-        article_browser.quit()
+        browser_pool.release(article_browser, is_broken=True)
         return False
 
     if download_successful:
         log('Download finished.(%s)' % time_report)
-        __move_downloaded_file(tag_name)
+        __move_downloaded_file(tag_name, download_path)
+        common.remove_dir_if_empty(download_path)
         return True
     else:
         log('Warning: Download failed.(%s)' % time_report)
-        if len(os.listdir(Constants.TMP_DOWNLOAD_PATH)) > 0:
-            mark_and_move(Constants.TMP_DOWNLOAD_PATH, Constants.DESTINATION_PATH)
+        if len(os.listdir(download_path)) > 0:
+            mark_and_move(download_path, Constants.DESTINATION_PATH)
             log('Error: Files left after download failure.')
+        common.remove_dir_if_empty(download_path)
         return False  # Nothing to do.
 
 
+def __get_gallery_id(url: str) -> str:
+    # e.g. /galleries/title-1234567.html
+    return url.split('?')[0].split('-')[-1].split('.')[0]
+
+
+def __get_destination_dir(tag_name: str, title: str, file_count: int) -> str:
+    # e.g. tag-012-title/
+    dir_name = title
+    for prohibited_char in common.Constants.PROHIBITED_CHARS:
+        dir_name = dir_name.replace(prohibited_char, '_')
+
+    # Add the file count.
+    dir_name = '%03d-' % file_count + dir_name
+
+    # Add the tag name at the head.
+    if tag_name:
+        dir_name = tag_name + '-' + dir_name
+
+    destination = Constants.DESTINATION_PATH + dir_name + '/'
+    common.check_dir_exists(destination)
+    return destination
+
+
+def fetch_gallery(gallery: dict, referer: str, tag_name: str = None) -> bool:
+    # gallery: {'title': title, 'files': [{'name': name, 'url': url}, ...]} from GALLERY_MANIFEST_SCRIPT
+    # Fetched into a folder of its own, moved into the destination only once complete:
+    # the destination may hold the gallery stored on a previous run.
+    common.check_dir_exists(Constants.DESTINATION_PATH)
+    fetch_dir = tempfile.mkdtemp(prefix='.fetching-', dir=Constants.DESTINATION_PATH) + '/'  # Same file system
+    try:
+        stored_names = __fetch_images(gallery['files'], referer, fetch_dir)
+        if not stored_names:
+            return False
+        destination = __get_destination_dir(tag_name, gallery['title'].strip(), len(gallery['files']))
+        for stored_name in stored_names:
+            os.replace(fetch_dir + stored_name, destination + stored_name)
+        return True
+    finally:
+        shutil.rmtree(fetch_dir, ignore_errors=True)
+
+
+def __fetch_images(images: [], referer: str, fetch_dir: str) -> []:
+    # Return the names stored in fetch_dir, None unless every image has arrived.
+    tor_pool = torpool.get_pool()
+    max_workers = Constants.MAX_CONCURRENT_FETCHES_PER_CIRCUIT * len(tor_pool.circuits)
+    stored_names = []
+    for _ in range(Constants.FETCH_ROUNDS):
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gallery') as executor:
+            futures = {executor.submit(__fetch_image, tor_pool, image['url'], referer, fetch_dir, image['name']):
+                       image for image in images}
+        failures = [(image, future.exception()) for future, image in futures.items() if future.exception()]
+        stored_names += [future.result() for future in futures if not future.exception()]
+        if not failures:
+            break
+        log('Warning: %d of %d images failed.(%s)' % (len(failures), len(images), failures[0][1]))
+        images = [image for image, _ in failures]
+    else:
+        return None
+
+    converter.wait_for_conversions()  # The png files are in place once converted.
+    missing = [stored_name for stored_name in stored_names if not os.path.exists(fetch_dir + stored_name)]
+    if missing:
+        log('Warning: %d images failed to convert.(%s)' % (len(missing), missing[0]))
+        return None
+    return stored_names
+
+
+def __fetch_image(tor_pool: torpool.TorPool, url: str, referer: str, destination: str, name: str):
+    # Stored under the name in the manifest, with the extension of the file served. WebP is converted to png.
+    # Return the stored name. Through the next circuit of the pool, which learns its throughput.
+    extension = common.split_on_last_pattern(url.split('?')[0], '.')[-1].lower()
+    file_path = destination + common.split_on_last_pattern(name, '.')[0] + '.' + extension
+    circuit = tor_pool.get_circuit()
+    start_time = datetime.now()
+    with tor_pool.get_session(circuit).get(url, headers={'Referer': referer}, stream=True,
+                                           timeout=downloader.Constants.DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with filesink.FileSink(file_path + '.part') as sink:
+            for chunk in response.iter_content(downloader.Constants.CHUNK_SIZE):
+                sink.write(chunk)
+    tor_pool.observe(circuit, sink.position, common.get_elapsed_sec(start_time))
+
+    if extension == 'webp':
+        png_path = common.split_on_last_pattern(file_path, '.')[0] + '.png'
+        os.rename(file_path + '.part', png_path + '.webp.part')
+        converter.submit_file(png_path + '.webp.part', png_path + '.part',
+                              lambda: blobstore.commit(png_path + '.part', png_path))
+        return os.path.basename(png_path)
+    blobstore.commit(file_path + '.part', file_path)
+    return os.path.basename(file_path)
+
+
 # Process the downloaded zip file.
-def __move_downloaded_file(tag_name: str):
+def __move_downloaded_file(tag_name: str, download_path: str):
     try:
         # Unzip the downloaded file.
-        zip_files = glob(Constants.TMP_DOWNLOAD_PATH + '*.zip')
+        zip_files = glob(download_path + '*.zip')
         for zip_file_path in zip_files:
             with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
                 # Compose the destination path name.
-                dir_name = zip_file_path.split('.zip')[0].split('/')[-1].split('|')[-1]\
-                    .strip('_').split('_')[-1].strip()
-                for prohibited_char in common.Constants.PROHIBITED_CHARS:
-                    dir_name = dir_name.replace(prohibited_char, '_')
-
-                # Add the file count.
-                file_count = len(zip_ref.namelist())
-                dir_name = '%03d-' % file_count + dir_name
-
-                # Add the tag name at the head.
-                if tag_name:
-                    dir_name = tag_name + '-' + dir_name
-
-                # Extract all to the composed destination path.
-                destination = Constants.DESTINATION_PATH + dir_name + '/'
-                zip_ref.extractall(destination)
+                title = zip_file_path.split('.zip')[0].split('/')[-1].split('|')[-1].strip('_').split('_')[-1].strip()
+                destination = __get_destination_dir(tag_name, title, len(zip_ref.namelist()))
+
+            # Extract all to the composed destination path, converting webp on the way.
+            ingest.ingest_zip(zip_file_path, lambda stored_name: destination + stored_name)
             os.remove(zip_file_path)  # Remove the zip file.
-            for file_name in os.listdir(destination):
-                if file_name.endswith('.webp'):
-                    common.convert_webp_to_png(destination, file_name)
     except Exception as post_download_exception:
         log('Error: Cannot process downloaded files.(%s)' % post_download_exception)
 
 
-def wait_for_download_start(dl_browser: webdriver.Chrome, loading_sec: float):
-    seconds = 0
+def wait_for_download_start(dl_browser: webdriver.Chrome, image_count: int, tracker=None):
+    # tracker: the devtools.DownloadTracker watching the progress bar, instead of polling it
     check_interval = 5
-    progress_bar_id = 'progressbar'
+    progress_bar_id = Constants.PROGRESS_BAR_ID
     progress_value_attr = 'aria-valuenow'
 
-    # The timeout: 30 ~ 3300 + a
-    timeout = max(30.0, loading_sec * 300)  # Generous, as a stalled script will return False anyway.
-    if timeout > 3300:
-        timeout = 3300 * random.uniform(1, 1.2)
+    # From the throughput and latency observed: long enough for the expected bytes, but stalls fail fast.
+    # Stalls count from the bar shown: the script may take long to start.
+    timeout = throughput.get_timeout(Constants.SITE, throughput.estimate_bytes(Constants.SITE, image_count))
+    clock = throughput.TransferClock(timeout, throughput.get_stall_sec(Constants.SITE))
+    if tracker:  # Woken by each change of the progress bar, reported by the page itself
+        return tracker.wait_for_progress(clock)
 
     # Is progress bar changing?
-    prev_progress = 0
     has_started = False
-
     dl_btn = dl_browser.find_element(By.ID, progress_bar_id)
-    consecutive_failures = 0
-    while seconds <= timeout:
-        time.sleep(check_interval)
-        seconds += check_interval
+    while True:
+        time.sleep(min(check_interval, clock.get_wait_sec()))
         is_download_btn_visible = dl_btn.get_attribute('style')
         if not is_download_btn_visible:  # Not visible: download ongoing.
-            # Set up the start flag and progress value
-            if not has_started:
-                has_started = True
-            if dl_btn.get_attribute(progress_value_attr):
-                progress = float(dl_btn.get_attribute(progress_value_attr))
-            else:
-                progress = 0.0
-
-            # Check the progress
-            if progress > prev_progress:  # Download ongoing
-                print('Download script progress %.1f ' % progress + '%\t' + '(%d/%d)' % (seconds, timeout))
-                consecutive_failures = 0
-            else:
-                if consecutive_failures < 10:
-                    print('Download script progress %.1f ' % progress + '%\t' +
-                          '(%d/%d)\t(STALLED)' % (seconds, timeout))
-                    consecutive_failures += 1
-                else:  # i.e., 10 consecutive failures.
-                    log('Warning: Download progress stopped.')
-                    return False  # It is certain that download stopped.
+            has_started = True
+            progress = float(dl_btn.get_attribute(progress_value_attr) or 0)
+            if progress != clock.received:
+                print('Download script progress %.1f ' % progress + '%\t' + '(%.0f" left)' % clock.get_wait_sec())
+            clock.update(progress)
         elif has_started:
             return True  # Download button visible again. Finished downloading.
-        # else: Download has not started. Wait to start download.
-    log('Warning: Download script timeout.')
-    return False  # Timeout reached.
+        else:  # Download has not started. Wait to start download.
+            print('Waiting for the download script to start. (%.0f" left)' % clock.get_wait_sec())
+
+        failure = clock.get_failure()
+        if failure:
+            log('Warning: %s' % failure)
+            return False
 
 
-def click_download_button(dl_browser: webdriver.Chrome, loading_sec: float) -> bool:
+def click_download_button(dl_browser: webdriver.Chrome, download_path: str, loading_sec: float,
+                          image_count: int) -> bool:
     btn_id = 'dl-button'
+    click_time = datetime.now()
+    # The events of the browser, if its DevTools can be reached: no polling.
+    tracker = devtools.get_tracker(dl_browser)
+    progress_tracker = None
     # Part 1. Wait to start downloading.
     try:
+        if tracker:
+            tracker.reset()
+            progress_tracker = tracker if tracker.watch_progress(Constants.PROGRESS_BAR_ID) else None
         dl_browser.find_element(By.ID, btn_id).click()
         print('"Download" button located.')
-        has_started = wait_for_download_start(dl_browser, loading_sec)
+        has_started = wait_for_download_start(dl_browser, image_count, progress_tracker)
     except selenium.common.exceptions.NoSuchElementException:
         log('Warning: Cannot locate the download button.')
         return False  # Failed in clicking the download button. Nothing to expect.
@@ -249,9 +384,12 @@ def click_download_button(dl_browser: webdriver.Chrome, loading_sec: float) -> b
 
     # Download started and it did not encounter exceptions.
     # Part 2. Wait to finish downloading.
-    is_finished = downloader.wait_finish_downloading(Constants.TMP_DOWNLOAD_PATH, Constants.LOG_PATH, loading_sec, 1,
-                                                     is_logged=False)
+    is_finished = downloader.wait_finish_downloading(download_path, Constants.LOG_PATH, loading_sec, 1,
+                                                     is_logged=False, tracker=tracker)
     if is_finished:
+        # Learn for the next galleries: the rate, and the size of an image.
+        size = sum(os.path.getsize(f) for f in glob(download_path + '*.zip'))
+        throughput.observe(Constants.SITE, size, common.get_elapsed_sec(click_time), loading_sec, image_count)
         return True
     else:
         log('Warning: crdownload timeout.')
@@ -262,6 +400,7 @@ def append_articles_to_scan(scan_list: [], placeholder: str, domain_tag, scannin
     max_page = page + scanning_span - 1  # To prevent infinite looping
     consecutive_failures = 0
     MAX_FAILURE = 3
+    common.block_urls(browser, Constants.BLOCKED_URL_PATTERNS)  # Only the rows are read.
 
     while page <= max_page and consecutive_failures < MAX_FAILURE:  # Page-wise
         start_time = datetime.now()  # A timer for monitoring performance
@@ -275,8 +414,7 @@ def append_articles_to_scan(scan_list: [], placeholder: str, domain_tag, scannin
             break
 
         for i in range(3):
-            soup = BeautifulSoup(browser.page_source, common.Constants.HTML_PARSER)
-            rows = soup.select('div.container > div.gallery-content > div')
+            rows = browser.execute_script(Constants.ROW_EXTRACTION_SCRIPT)
             if len(rows) > 0:
                 break  # Article list has been loaded.
             else:  # Reload the page.
@@ -290,7 +428,7 @@ def append_articles_to_scan(scan_list: [], placeholder: str, domain_tag, scannin
 
         for i, row in enumerate(rows):  # Inspect the rows
             try:
-                tst_str = row.select_one('div > div > p.date').string  # 2021-09-19 23:47:42
+                tst_str = row['date']  # 2021-09-19 23:47:42
                 day_diff = __get_date_difference(tst_str)
                 if day_diff:
                     if day_diff <= Constants.TOO_YOUNG_DAY:  # Still, not mature: uploaded on the yesterday.
@@ -303,9 +441,8 @@ def append_articles_to_scan(scan_list: [], placeholder: str, domain_tag, scannin
                             (page, common.get_elapsed_sec(start_time)), False)
                         return
                     else:
-                        article_link_tag = row.select_one('h1 > a')
-                        url = Constants.ROOT_DOMAIN + article_link_tag['href']
-                        article_title = article_link_tag.string.split('|')[-1].strip()
+                        url = Constants.ROOT_DOMAIN + row['href']
+                        article_title = row['title'].split('|')[-1].strip()
 
                         # Finally, check duplicates
                         for info in scan_list:
@@ -347,14 +484,12 @@ def process_domain(scan_list: [], placeholder: str, domain_tag: str, scanning_sp
 if __name__ == "__main__":
     main_scan_list = []
     buffer_list = []
+    browser_pool = browserpool.BrowserPool(initiate_browser, is_keeping_cookies=False)
     for subdirectory, directory_tag in Constants.SUBDIRECTORIES:
-        browser = initiate_browser()
-        try:
+        with browser_pool.browser() as browser:
             # Append to the scanning list.
             process_domain(main_scan_list, Constants.ROOT_DOMAIN + subdirectory, directory_tag,
                            scanning_span=Constants.SCANNING_SPAN, starting_page=Constants.STARTING_PAGE)
-        finally:
-            browser.quit()
 
     # Then, scan the list
     for k in range(3):
@@ -383,4 +518,7 @@ if __name__ == "__main__":
             failed_url = article_info[0]
             if failed_url.strip():
                 log(failed_url, has_tst=False)
+    browser_pool.close()
+    converter.wait_for_conversions()
+    blobstore.collect_garbage_if_due()
     log("Script finished.")
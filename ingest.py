@@ -0,0 +1,112 @@
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import blobstore
+import common
+import converter
+import filesink
+
+
+class Constants:
+    MAX_WORKERS = 4  # Members decompressed at the same time: zlib releases the GIL.
+
+
+def ingest_zip(zip_path: str, get_destination_path, on_stored=None) -> int:
+    # Read each member once, straight into its final path: get_destination_path(stored name) -> path.
+    # The stored names are the base names of the members, made unique if the same name is in different folders.
+    # WebP members are stored as png, converted on the way. on_stored(path) follows each stored file.
+    # Memory is bounded by the workers and their buffers, whatever the size of the archive.
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = [member for member in zip_ref.infolist() if not member.is_dir()]
+
+    handles = threading.local()  # A ZipFile per worker: a shared one serialises the reads.
+    opened = []
+    opened_lock = threading.Lock()
+
+    stored_names = __get_stored_names(members)
+
+    def ingest_member(member: zipfile.ZipInfo):
+        if not hasattr(handles, 'zip_ref'):
+            handles.zip_ref = zipfile.ZipFile(zip_path, 'r')
+            with opened_lock:
+                opened.append(handles.zip_ref)
+        __ingest_member(handles.zip_ref, member, stored_names[member.filename], get_destination_path, on_stored)
+
+    try:
+        with ThreadPoolExecutor(max_workers=Constants.MAX_WORKERS, thread_name_prefix='ingest') as executor:
+            futures = [executor.submit(ingest_member, member) for member in members]
+        for future in futures:
+            future.result()  # Raise the first failure, if any.
+    finally:
+        for zip_ref in opened:
+            zip_ref.close()
+    return len(members)
+
+
+def __get_stored_names(members: []) -> {}:
+    # {member name: stored name}. Flattened to the base names, unless the same name comes from different folders:
+    # then the folders are kept in the name. (e.g. ch1/001.jpg -> ch1_001.jpg) Never outside the destination.
+    def get_stored_name(member_name: str) -> str:
+        stored_name = member_name.replace('\\', '/').split('/')[-1]
+        if stored_name.endswith('.webp'):  # Converted
+            stored_name = common.split_on_last_pattern(stored_name, '.')[0] + '.png'
+        return stored_name
+
+    name_counts = {}
+    for member in members:
+        stored_name = get_stored_name(member.filename)
+        name_counts[stored_name] = name_counts.get(stored_name, 0) + 1
+
+    stored_names = {}
+    taken = set()
+    for member in members:
+        stored_name = get_stored_name(member.filename)
+        if name_counts[stored_name] > 1:
+            folders = [part for part in member.filename.replace('\\', '/').split('/')[:-1]
+                       if part not in ('', '.', '..')]
+            stored_name = '_'.join(folders + [stored_name])
+        stem, extension = common.split_on_last_pattern(stored_name, '.') if '.' in stored_name else (stored_name, '')
+        n = 1
+        while stored_name in taken:  # Still the same, e.g. a/b_c.jpg and a_b/c.jpg
+            stored_name = '%s-%d' % (stem, n) + ('.' + extension if extension else '')
+            n += 1
+        taken.add(stored_name)
+        stored_names[member.filename] = stored_name
+    return stored_names
+
+
+def __ingest_member(zip_ref: zipfile.ZipFile, member: zipfile.ZipInfo, stored_name: str, get_destination_path,
+                    on_stored):
+    if not member.filename.endswith('.webp'):
+        file_path = blobstore.extract(zip_ref, member, *os.path.split(get_destination_path(stored_name)))
+        if on_stored:
+            on_stored(file_path)
+        return
+
+    file_path = get_destination_path(stored_name)
+    webp_path = common.split_on_last_pattern(file_path, '.')[0] + '.webp'
+
+    def store_converted():
+        blobstore.commit(file_path + '.part', file_path)
+        if on_stored:
+            on_stored(file_path)
+
+    def keep_webp(data: bytes = None):
+        # Stored as it is, since the zip is removed after ingesting.
+        if data is not None:
+            with filesink.FileSink(webp_path + '.part') as sink:
+                sink.write(data)
+        blobstore.commit(webp_path + '.part', webp_path)
+        if os.path.exists(file_path + '.part'):  # Written partly
+            os.remove(file_path + '.part')
+        print('Warning: kept unconverted.(%s)' % webp_path)
+
+    if member.file_size <= converter.Constants.IN_MEMORY_LIMIT:  # Convert from the decompressed bytes.
+        data = zip_ref.read(member)
+        converter.submit_bytes(data, file_path + '.part', store_converted, lambda: keep_webp(data))
+    else:
+        with zip_ref.open(member) as source, filesink.FileSink(webp_path + '.part') as sink:
+            for data in iter(lambda: source.read(filesink.Constants.BUFFER_SIZE), b''):
+                sink.write(data)
+        converter.submit_file(webp_path + '.part', file_path + '.part', store_converted, keep_webp)
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import common
+
+
+class Constants:
+    LEDGER_PATH = os.path.join(common.Constants.DUMP_PATH, 'ledger.sqlite3')
+    # Eviction: the date windows of the crawlers never look back this far.
+    RETENTION_DAYS = 90
+    MAX_ENTRIES = 5000000
+    BUSY_TIMEOUT = 30  # Seconds to wait for another writer, e.g. a crawler running at the same time
+
+
+__local = threading.local()  # A connection per thread: sqlite3 connections are not to be shared.
+__compaction_lock = threading.Lock()
+__is_compacted = False
+
+
+def normalize_url(url: str) -> str:
+    # The same source under a different scheme, host case, default port, query order or fragment is the same.
+    if url.startswith('//'):
+        url = 'https:' + url
+    chunks = urlsplit(url.strip())
+    host = chunks.hostname or ''
+    if chunks.port and chunks.port not in (80, 443):
+        host += ':%d' % chunks.port
+    query = urlencode(sorted(parse_qsl(chunks.query, keep_blank_values=True)))
+    return host + (chunks.path or '/') + ('?' + query if query else '')
+
+
+def __get_connection() -> sqlite3.Connection:
+    connection = getattr(__local, 'connection', None)
+    if connection is None:
+        common.check_dir_exists(os.path.dirname(Constants.LEDGER_PATH))
+        connection = sqlite3.connect(Constants.LEDGER_PATH, timeout=Constants.BUSY_TIMEOUT, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')  # Readers do not block the writer, and vice versa.
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS downloads '
+                           '(url TEXT PRIMARY KEY, size INTEGER, path TEXT, tst REAL) WITHOUT ROWID')
+        connection.execute('CREATE INDEX IF NOT EXISTS downloads_tst ON downloads (tst)')
+        __local.connection = connection
+        __compact_once()
+    return connection
+
+
+def __compact_once():
+    global __is_compacted
+    with __compaction_lock:
+        if not __is_compacted:
+            __is_compacted = True
+            compact()
+
+
+def lookup(url: str):
+    # Return (size, path) of the source if it has been downloaded, None otherwise.
+    return __get_connection().execute('SELECT size, path FROM downloads WHERE url = ?',
+                                      (normalize_url(url),)).fetchone()
+
+
+def record(url: str, size: int, path: str):
+    __get_connection().execute('INSERT OR REPLACE INTO downloads (url, size, path, tst) VALUES (?, ?, ?, ?)',
+                               (normalize_url(url), size, path, time.time()))
+
+
+def compact():
+    # Evict the expired, then the oldest beyond the limit. Run once per process, on the first use.
+    connection = __get_connection()
+    expiry = time.time() - Constants.RETENTION_DAYS * 24 * 60 * 60
+    evicted = connection.execute('DELETE FROM downloads WHERE tst < ?', (expiry,)).rowcount
+    excess = connection.execute('SELECT COUNT(*) FROM downloads').fetchone()[0] - Constants.MAX_ENTRIES
+    if excess > 0:
+        evicted += connection.execute('DELETE FROM downloads WHERE url IN '
+                                      '(SELECT url FROM downloads ORDER BY tst LIMIT ?)', (excess,)).rowcount
+    if evicted > 0:
+        print('Evicted %d entries from the download ledger.' % evicted)
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
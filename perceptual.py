@@ -0,0 +1,165 @@
+import fcntl
+import os
+import threading
+import numpy as np
+from PIL import Image
+import common
+
+
+class Constants:
+    INDEX_PATH = os.path.join(common.Constants.DUMP_PATH, 'perceptual')  # .u64: hashes, .off: name offsets, .txt: names
+    HASH_KIND = 'phash'  # 'phash': robust against recompressing and resizing, 'dhash': cheaper
+    MAX_DISTANCE = 6  # In bits, out of 64
+    # 'flag': log the near-duplicate, 'skip': remove it as well
+    NEAR_DUPLICATE_ACTION = 'flag'
+    IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'jfif', 'webp')
+
+    # Multi-index hashing: 64 bits in bands of 16 bits
+    BAND_COUNT = 4
+    REBUILD_THRESHOLD = 4096  # Entries searched by brute force before rebuilding the bands
+
+
+__POPCOUNT = np.array([bin(n).count('1') for n in range(256)], dtype=np.uint8)
+__DCT_SIZE = 32
+# The DCT-II basis: dct(x) = basis @ x
+__DCT_BASIS = np.cos(np.pi * np.outer(np.arange(__DCT_SIZE), 2 * np.arange(__DCT_SIZE) + 1) / (2 * __DCT_SIZE))
+
+__index = None
+__index_lock = threading.Lock()
+
+
+def __pack_bits(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+
+def dhash(img: Image.Image) -> int:
+    # Whether each pixel is brighter than its right neighbour, on a 9x8 thumbnail
+    pixels = np.asarray(img.convert('L').resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return __pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(img: Image.Image) -> int:
+    # Whether each of the lowest 8x8 frequencies is above their median, on a 32x32 thumbnail
+    pixels = np.asarray(img.convert('L').resize((__DCT_SIZE, __DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    frequencies = (__DCT_BASIS @ pixels @ __DCT_BASIS.T)[:8, :8]
+    return __pack_bits(frequencies > np.median(frequencies.flatten()[1:]))  # Except the DC term
+
+
+def hash_image(file_path: str) -> int:
+    with Image.open(file_path) as img:  # The first frame, if animated
+        return phash(img) if Constants.HASH_KIND == 'phash' else dhash(img)
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return __POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class Index:
+    # The hashes in a flat uint64 array, searched through BAND_COUNT sorted 16-bit bands.
+    # If two hashes differ in d bits, at least one band differs in d // BAND_COUNT bits or less.
+    def __init__(self, index_path: str):
+        self.path = index_path
+        common.check_dir_exists(os.path.dirname(index_path))
+        self.hashes = np.fromfile(index_path + '.u64', dtype='<u8') if os.path.exists(index_path + '.u64') \
+            else np.empty(0, dtype='<u8')
+        self.tail = []  # Added since the bands were built
+        self.band_values = []  # Sorted 16-bit values of each band
+        self.band_orders = []  # Their positions in self.hashes
+        self.build_bands()
+
+    def build_bands(self):
+        if self.tail:
+            self.hashes = np.concatenate((self.hashes, np.array(self.tail, dtype='<u8')))
+            self.tail = []
+        self.band_values, self.band_orders = [], []
+        for band in range(Constants.BAND_COUNT):
+            values = ((self.hashes >> np.uint64(16 * band)) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(values, kind='stable').astype(np.int64)
+            self.band_values.append(values[order])
+            self.band_orders.append(order)
+
+    def __band_neighbours(self, value: int, radius: int) -> np.ndarray:
+        neighbours = {value}
+        for _ in range(radius):
+            neighbours |= {n ^ (1 << bit) for n in neighbours for bit in range(16)}
+        return np.array(sorted(neighbours), dtype=np.uint16)
+
+    def search(self, value: int, max_distance: int):
+        # Return (position, distance) of the closest hash within max_distance, None otherwise.
+        radius = max_distance // Constants.BAND_COUNT
+        candidates = []
+        for band in range(Constants.BAND_COUNT):
+            neighbours = self.__band_neighbours((value >> (16 * band)) & 0xFFFF, radius)
+            starts = np.searchsorted(self.band_values[band], neighbours, 'left')
+            ends = np.searchsorted(self.band_values[band], neighbours, 'right')
+            for start, end in zip(starts, ends):
+                if start < end:
+                    candidates.append(self.band_orders[band][start:end])
+        positions = np.unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+        if self.tail:  # Not in the bands yet: brute force.
+            positions = np.concatenate((positions, np.arange(len(self.hashes), len(self.hashes) + len(self.tail))))
+        if len(positions) == 0:
+            return None
+        hashes = np.concatenate((self.hashes, np.array(self.tail, dtype='<u8')))[positions] if self.tail \
+            else self.hashes[positions]
+        distances = hamming_distances(hashes, value)
+        closest = int(np.argmin(distances))
+        return (int(positions[closest]), int(distances[closest])) if distances[closest] <= max_distance else None
+
+    def add(self, value: int, file_path: str):
+        # Append to the files, locked against the other crawlers.
+        with open(self.path + '.txt', 'ab') as name_file, open(self.path + '.off', 'ab') as offset_file, \
+                open(self.path + '.u64', 'ab') as hash_file:
+            fcntl.flock(hash_file, fcntl.LOCK_EX)
+            try:
+                # Catch up with the others, so that the positions match those in the files.
+                count = len(self.hashes) + len(self.tail)
+                if os.fstat(hash_file.fileno()).st_size // 8 > count:
+                    self.tail.extend(np.fromfile(self.path + '.u64', dtype='<u8', offset=8 * count).tolist())
+                offset_file.write(np.array([name_file.seek(0, os.SEEK_END)], dtype='<u8').tobytes())
+                name_file.write(file_path.encode() + b'\n')
+                hash_file.write(np.array([value], dtype='<u8').tobytes())
+            finally:
+                fcntl.flock(hash_file, fcntl.LOCK_UN)
+        self.tail.append(value)
+        if len(self.tail) >= Constants.REBUILD_THRESHOLD:
+            self.build_bands()
+
+    def get_name(self, position: int) -> str:
+        offset = np.fromfile(self.path + '.off', dtype='<u8', count=1, offset=8 * position)[0]
+        with open(self.path + '.txt', 'rb') as names:
+            names.seek(int(offset))
+            return names.readline().decode().rstrip('\n')
+
+
+def __get_index() -> Index:
+    global __index
+    if __index is None:
+        __index = Index(Constants.INDEX_PATH)
+    return __index
+
+
+def screen(file_path: str) -> bool:
+    # Check a stored image against the index. Return False if removed as a near-duplicate.
+    if common.split_on_last_pattern(file_path, '.')[-1].lower() not in Constants.IMAGE_EXTENSIONS:
+        return True
+    try:
+        value = hash_image(file_path)
+    except Exception as hash_exception:
+        print('Warning: cannot hash %s.(%s)' % (file_path, hash_exception))
+        return True
+
+    with __index_lock:
+        index = __get_index()
+        found = index.search(value, Constants.MAX_DISTANCE)
+        if found:
+            position, distance = found
+            original = index.get_name(position)
+            print('Near-duplicate(%d bits) of %s: %s' % (distance, original, file_path))
+            if Constants.NEAR_DUPLICATE_ACTION == 'skip' and os.path.abspath(original) != os.path.abspath(file_path):
+                os.remove(file_path)
+                return False
+            return True
+        index.add(value, file_path)
+    return True
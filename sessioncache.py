@@ -0,0 +1,62 @@
+import json
+import os
+import time
+import common
+
+
+class Constants:
+    CACHE_PATH = os.path.join(common.Constants.DUMP_PATH, 'sessions')  # A json file per site
+    # Cookies without an expiry last as long as the browser does: trust them for this long after saving.
+    SESSION_COOKIE_MAX_AGE = 12 * 60 * 60
+
+
+def __get_cache_path(site: str) -> str:
+    return os.path.join(Constants.CACHE_PATH, '%s.json' % site)
+
+
+def save(site: str, driver):
+    # Call after logging in.
+    common.check_dir_exists(Constants.CACHE_PATH)
+    path = __get_cache_path(site)
+    with open(path + '.tmp', 'w') as cache_file:
+        json.dump({'saved': time.time(), 'cookies': common.get_all_cookies(driver)}, cache_file)
+    os.replace(path + '.tmp', path)
+
+
+def load(site: str) -> []:
+    # Return the unexpired cookies, None if nothing is cached.
+    try:
+        with open(__get_cache_path(site)) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    now = time.time()
+    is_session_alive = now - cache['saved'] < Constants.SESSION_COOKIE_MAX_AGE
+    cookies = [cookie for cookie in cache['cookies']
+               if (cookie.get('expires', -1) > now) or (cookie.get('expires', -1) <= 0 and is_session_alive)]
+    return cookies if cookies else None
+
+
+def invalidate(site: str):
+    # Call when the cached cookies have been rejected.
+    try:
+        os.remove(__get_cache_path(site))
+    except FileNotFoundError:
+        pass
+
+
+def restore_to_driver(site: str, driver) -> bool:
+    # Set the cookies without visiting the domains. Return False if nothing to restore.
+    cookies = load(site)
+    if not cookies:
+        return False
+    params = ('name', 'value', 'domain', 'path', 'expires', 'httpOnly', 'secure', 'sameSite')
+    restored = []
+    for cookie in cookies:
+        restored.append({k: cookie[k] for k in params if k in cookie})
+        if restored[-1].get('expires', -1) <= 0:  # A session cookie
+            restored[-1].pop('expires', None)
+    driver.execute_cdp_cmd('Network.setCookies', {'cookies': restored})
+    print('Restored %d cookies of %s.' % (len(cookies), site))
+    return True
+
@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+import common
+
+
+class Constants:
+    MODEL_PATH = os.path.join(common.Constants.DUMP_PATH, 'throughput.json')
+    ALPHA = 0.3  # The weight of a new observation in the moving averages
+
+    # Until observed
+    DEFAULT_BYTES_PER_SEC = 200 * 1000
+    DEFAULT_LATENCY = 5.0
+    DEFAULT_BYTES_PER_ITEM = 2 * 1000 * 1000  # e.g. a zip file of dc, an image of hi
+
+    SAFETY_FACTOR = 3  # Slower than the average by this factor is a failure.
+    MIN_TIMEOUT = 30
+    MAX_TIMEOUT = 3600
+    MIN_STALL_SEC = 15
+
+
+__model = None  # {'site': {'bytes_per_sec': float, 'latency': float, 'bytes_per_item': float}, ...}
+__model_lock = threading.Lock()
+
+
+def __load() -> dict:
+    global __model
+    if __model is None:
+        try:
+            with open(Constants.MODEL_PATH) as f:
+                __model = json.load(f)
+        except (OSError, ValueError):
+            __model = {}
+    return __model
+
+
+def __save():
+    common.check_dir_exists(os.path.dirname(Constants.MODEL_PATH))
+    temp_path = Constants.MODEL_PATH + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(__model, f, indent=2)
+    os.replace(temp_path, Constants.MODEL_PATH)
+
+
+def get(site: str) -> dict:
+    with __model_lock:
+        stats = dict(__load().get(site, {}))
+    stats.setdefault('bytes_per_sec', Constants.DEFAULT_BYTES_PER_SEC)
+    stats.setdefault('latency', Constants.DEFAULT_LATENCY)
+    stats.setdefault('bytes_per_item', Constants.DEFAULT_BYTES_PER_ITEM)
+    return stats
+
+
+def observe(site: str, size: int = None, elapsed: float = None, latency: float = None, items: int = None):
+    # Update the moving averages of the site with a finished transfer, and persist them for the next runs.
+    def moving_average(stats: dict, key: str, value: float):
+        stats[key] = value if key not in stats else (1 - Constants.ALPHA) * stats[key] + Constants.ALPHA * value
+
+    with __model_lock:
+        stats = __load().setdefault(site, {})
+        if size and elapsed:
+            moving_average(stats, 'bytes_per_sec', size / elapsed)
+        if latency:
+            moving_average(stats, 'latency', latency)
+        if size and items:
+            moving_average(stats, 'bytes_per_item', size / items)
+        __save()
+
+
+def estimate_bytes(site: str, items: int = 1) -> float:
+    return get(site)['bytes_per_item'] * items
+
+
+def get_timeout(site: str, expected_bytes: float = None) -> float:
+    # Long enough for the expected bytes at a fraction of the usual rate
+    stats = get(site)
+    if expected_bytes is None:
+        expected_bytes = stats['bytes_per_item']
+    timeout = Constants.SAFETY_FACTOR * (stats['latency'] + expected_bytes / stats['bytes_per_sec'])
+    return min(max(timeout, Constants.MIN_TIMEOUT), Constants.MAX_TIMEOUT)
+
+
+def get_stall_sec(site: str) -> float:
+    # No progress for this long, and the transfer is not coming back.
+    return max(Constants.MIN_STALL_SEC, Constants.SAFETY_FACTOR * get(site)['latency'])
+
+
+class TransferClock:
+    # The one rule of every wait on a transfer: stalls count from the first progress only,
+    # e.g. not while the server builds a zip, and once the size is known, the deadline follows the bytes remaining.
+    def __init__(self, timeout: float, stall_sec: float = None, site: str = None, expected_bytes: float = None):
+        self.timeout = timeout
+        self.stall_sec = stall_sec
+        self.site = site  # The model of the site, for the deadline from the bytes remaining
+        self.expected_bytes = expected_bytes  # In all, if not reported by the transfer
+        self.deadline = time.monotonic() + timeout
+        self.received = None  # None: not started
+        self.last_progress_time = None
+
+    def update(self, received, total: float = None):
+        # received: the bytes, or any other measure of progress. None before the transfer starts.
+        if received is None or received == self.received:
+            return
+        now = time.monotonic()
+        self.received, self.last_progress_time = received, now
+        total = total if total else self.expected_bytes
+        if self.site and total and total > received:
+            self.deadline = now + get_timeout(self.site, total - received)
+
+    def get_failure(self) -> str:
+        # The reason to give up, None while the transfer may go on
+        now = time.monotonic()
+        if self.stall_sec and self.last_progress_time is not None and now - self.last_progress_time >= self.stall_sec:
+            return 'Download stalled for %d".' % (now - self.last_progress_time)
+        if now >= self.deadline:
+            return 'Download timeout reached.'
+        return None
+
+    def get_wait_sec(self) -> float:
+        # Until a failure could happen, without progress
+        wake_at = self.deadline
+        if self.stall_sec and self.last_progress_time is not None:
+            wake_at = min(wake_at, self.last_progress_time + self.stall_sec)
+        return max(0.0, wake_at - time.monotonic())
@@ -0,0 +1,157 @@
+import itertools
+import socket
+import statistics
+import threading
+import time
+import common
+
+
+class Constants:
+    # Each SOCKS port is a circuit of its own (SocksPort lines in torrc).
+    # On each port, different credentials are isolated into different circuits as well (IsolateSOCKSAuth).
+    SOCKS_HOST = '127.0.0.1'
+    SOCKS_PORTS = (9050,)
+    ISOLATIONS_PER_PORT = 4  # Circuits by credentials, for the HTTP sessions: Chrome cannot pass SOCKS credentials.
+    CONTROL_PORT = 9051
+    CONTROL_PASSWORD = ''  # HashedControlPassword in torrc, if any
+
+    # Rotating the slow circuits out
+    THROUGHPUT_ALPHA = 0.3  # The weight of the latest sample
+    MIN_SAMPLES = 3  # Before judging a circuit
+    SLOW_RATIO = 0.25  # Of the median throughput of the circuits
+    NEWNYM_INTERVAL = 10  # Tor ignores more frequent signals.
+
+
+class Circuit:
+    def __init__(self, host: str, port: int, isolation: str = None):
+        self.host = host
+        self.port = port
+        self.isolation = isolation  # The SOCKS user name, None for the port only
+        self.generation = 0  # Changing the credentials builds a new circuit.
+        self.rate = None  # Bytes per second, averaged
+        self.samples = 0
+        self.session = None
+        self.is_slow = False  # Out of the turns until refreshed
+
+    def get_proxy_url(self) -> str:
+        # socks5h: the names are resolved through Tor as well.
+        if self.isolation:
+            return 'socks5h://%s-%d:x@%s:%d' % (self.isolation, self.generation, self.host, self.port)
+        return 'socks5h://%s:%d' % (self.host, self.port)
+
+    def get_browser_proxy(self) -> str:
+        return 'socks5://%s:%d' % (self.host, self.port)
+
+    def __str__(self):
+        return '%s:%d' % (self.host, self.port) + ('(%s-%d)' % (self.isolation, self.generation)
+                                                   if self.isolation else '')
+
+
+class TorPool:
+    # Browsers and sessions assigned to circuits in turn, the slow circuits rotated out.
+    # The ports can be those of local stand-in SOCKS proxies, with is_controlled=False.
+    def __init__(self, ports: () = None, isolations_per_port: int = None, host: str = None,
+                 control_port: int = None, control_password: str = None, is_controlled: bool = True):
+        host = host if host else Constants.SOCKS_HOST
+        ports = ports if ports else Constants.SOCKS_PORTS
+        isolations = isolations_per_port if isolations_per_port else Constants.ISOLATIONS_PER_PORT
+        self.port_circuits = [Circuit(host, port) for port in ports]
+        self.circuits = [Circuit(host, port, 'accr%d' % i) for port in ports for i in range(isolations)] \
+            if isolations > 1 else self.port_circuits
+        self.control_address = (host, control_port if control_port else Constants.CONTROL_PORT)
+        self.is_controlled = is_controlled  # Whether NEWNYM can be signalled
+        self.control_password = control_password if control_password is not None else Constants.CONTROL_PASSWORD
+        self.session_turns = itertools.count()
+        self.browser_turns = itertools.count()
+        self.last_newnym_time = 0
+        self.lock = threading.Lock()
+
+    def get_circuit(self) -> Circuit:
+        return self.__get_next(self.circuits, self.session_turns)
+
+    def get_browser_circuit(self) -> Circuit:
+        return self.__get_next(self.port_circuits, self.browser_turns)
+
+    def __get_next(self, circuits: [], turns) -> Circuit:
+        # Skipping the slow circuits, unless all of them are.
+        with self.lock:
+            if any(circuit.is_slow for circuit in self.port_circuits) and self.__signal_newnym():
+                self.__refresh_ports()
+            available = [circuit for circuit in circuits if not circuit.is_slow]
+        available = available if available else circuits
+        return available[next(turns) % len(available)]
+
+    def get_session(self, circuit: Circuit = None):
+        # A pooled session through the circuit, built again when the circuit is rotated.
+        circuit = circuit if circuit else self.get_circuit()
+        with self.lock:
+            if circuit.session is None:
+                proxy_url = circuit.get_proxy_url()
+                circuit.session = common.build_session({'http': proxy_url, 'https': proxy_url})
+            return circuit.session
+
+    def observe(self, circuit: Circuit, size: int, elapsed: float):
+        # Learn the throughput of the circuit, rotating it out if far slower than the others.
+        if elapsed <= 0:
+            return
+        with self.lock:
+            rate = size / elapsed
+            circuit.rate = rate if circuit.rate is None else \
+                Constants.THROUGHPUT_ALPHA * rate + (1 - Constants.THROUGHPUT_ALPHA) * circuit.rate
+            circuit.samples += 1
+            rates = [c.rate for c in self.circuits if c.rate is not None]
+            if not circuit.is_slow and circuit.samples >= Constants.MIN_SAMPLES and len(rates) > 1 and \
+                    circuit.rate < Constants.SLOW_RATIO * statistics.median(rates):
+                print('Rotating a slow circuit %s: %.0f KB/s.' % (circuit, circuit.rate / 1024))
+                self.__rotate(circuit)
+
+    def __rotate(self, circuit: Circuit):
+        if circuit.isolation:  # New credentials: a new circuit for this one only.
+            circuit.generation += 1
+            self.__refresh(circuit)
+        elif self.__signal_newnym():  # New circuits for the new connections of every port.
+            self.__refresh_ports()
+        else:  # Until NEWNYM can be signalled, if ever: e.g. stand-in proxies
+            circuit.is_slow = True
+
+    def __refresh_ports(self):
+        for port_circuit in self.port_circuits:
+            self.__refresh(port_circuit)
+
+    def __refresh(self, circuit: Circuit):
+        if circuit.session is not None:  # Its pooled connections go through the old circuit.
+            circuit.session.close()
+            circuit.session = None
+        circuit.rate, circuit.samples = None, 0
+        circuit.is_slow = False
+
+    def __signal_newnym(self) -> bool:
+        # At most once in the interval, succeeded or not: the control port may be unreachable.
+        if not self.is_controlled or time.time() - self.last_newnym_time < Constants.NEWNYM_INTERVAL:
+            return False
+        self.last_newnym_time = time.time()
+        try:
+            with socket.create_connection(self.control_address, timeout=10) as control:
+                control.sendall(('AUTHENTICATE "%s"\r\nSIGNAL NEWNYM\r\nQUIT\r\n' %
+                                 self.control_password).encode())
+                replies = control.makefile().read()
+            if not all(line.startswith('250') for line in replies.splitlines() if line):
+                print('Warning: NEWNYM refused.(%s)' % replies.strip())
+                return False
+            return True
+        except OSError as control_exception:
+            print('Warning: cannot reach the Tor control port.(%s)' % control_exception)
+            return False
+
+
+__pool = None
+__pool_lock = threading.Lock()
+
+
+def get_pool() -> TorPool:
+    # The process-wide pool, as configured in Constants.
+    global __pool
+    with __pool_lock:
+        if __pool is None:
+            __pool = TorPool()
+        return __pool